@@ -45,14 +45,22 @@ MONITOR_COPY_DIRS = {
     },
     BACKUP_DIR_EBACKUP: {
         "remotes": [
-            {"name": "pikpak-encrypted-backup", "path": ""},
-            {"name": "gdrive-encrypted-backup", "path": ""},
+            {"name": "pikpak-encrypted-backup", "path": "", "account": "pikpak"},
+            {"name": "gdrive-encrypted-backup", "path": "", "account": "gdrive"},
         ],
     },
 }
 
 DEFAULT_OFFSET_DAYS = 7
 
+# Max rclone commands running at once per remote account, different accounts run in parallel.
+# A remote counts against its "account" in MONITOR_COPY_DIRS (crypt remotes wrap one), else its name.
+REMOTE_CONCURRENCY = {
+    "pikpak": 2,
+    "gdrive": 4,
+}
+DEFAULT_REMOTE_CONCURRENCY = 1
+
 
 RCLONE_ARGS_COMMON = [
     "-v",
@@ -73,14 +81,15 @@ def print_debug(msg):
         print_log(msg)
 
 
-def run_shell_realtime(cmd):
+def run_shell_realtime(cmd, prefix=""):
     print_debug(f"run command realtime [{' '.join(cmd)}] ...")
     process = subprocess.Popen(
         cmd, env=os.environ.copy(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
     )
 
+    # prefix tells apart the output of commands running in parallel
     for line in process.stdout:
-        print(line.rstrip())
+        print(f"{prefix}{line.rstrip()}")
 
     process.wait()
     return process.returncode
@@ -104,8 +113,8 @@ def rclone_get(action, args, remote, target):
 
 def rclone_run(action, args, remote, source, target):
     cmd = ["rclone", action] + args + RCLONE_ARGS_COMMON + [str(source), f"{remote}:{target}"]
-    code = run_shell_realtime(cmd)
-    print_log(f"command return code: {code}")
+    code = run_shell_realtime(cmd, prefix=f"[{remote}] ")
+    print_log(f"[{remote}] command return code: {code}")
     return code, " ".join(cmd)
 
 
@@ -12,6 +12,8 @@ import argparse
 import shutil
 from pathlib import Path
 from datetime import datetime, timedelta
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import common
 
@@ -112,15 +114,41 @@ def sync_rclone_delete_remote_only(source, mdir, remote, root_path):
     return run_rclone(common.rclone_sync_delete_remote_only, source, mdir, remote, root_path)
 
 
+def copy_entries(jobs):
+    """
+    Runs copy_rclone for (source, mdir, remote) jobs and yields (returncode, cmd) as they finish.
+    Each remote account gets its own pool of common.REMOTE_CONCURRENCY workers, so uploads to
+    different accounts run in parallel without exceeding the rate limits of any of them.
+    """
+    pools = {}
+    futures = []
+    try:
+        for source, mdir, remote in jobs:
+            account = remote.get("account", remote["name"])
+            if account not in pools:
+                workers = common.REMOTE_CONCURRENCY.get(account, common.DEFAULT_REMOTE_CONCURRENCY)
+                pools[account] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=account)
+            futures.append(pools[account].submit(copy_rclone, source, mdir, remote["name"], remote["path"]))
+
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # closed early on EXIT_IMMEDIATELY, drop the copies not started yet
+        for pool in pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
 def run(func):
     failed_cmds = []
 
-    for [returncode, cmd] in func():
-        if returncode != 0:
-            if common.EXIT_IMMEDIATELY:
-                sys.exit(1)
-            else:
-                failed_cmds.append(cmd)
+    # closing waits for the running copies before exiting
+    with closing(func()) as results:
+        for [returncode, cmd] in results:
+            if returncode != 0:
+                if common.EXIT_IMMEDIATELY:
+                    sys.exit(1)
+                else:
+                    failed_cmds.append(cmd)
 
     if len(failed_cmds) > 0:
         common.print_log("Some operations failed:")
@@ -129,13 +157,16 @@ def run(func):
         sys.exit(1)
 
 
-def copy_latest_files(offset_days):
+def copy_latest_jobs(offset_days):
     for mdir, info in common.MONITOR_COPY_DIRS.items():
         common.print_log(f"start to copy recent files in dir {mdir}")
         for source in get_entries(mdir, offset_days):
             for remote in info["remotes"]:
-                returncode, cmd = copy_rclone(source, mdir, remote["name"], remote["path"])
-                yield [returncode, cmd]
+                yield source, mdir, remote
+
+
+def copy_latest_files(offset_days):
+    return copy_entries(copy_latest_jobs(offset_days))
 
 
 def copy_latest(offset_days):
@@ -145,9 +176,7 @@ def copy_latest(offset_days):
 def copy_all_files(mdir):
     info = common.MONITOR_COPY_DIRS[mdir]
     common.print_log(f"start to copy all files in dir {mdir}")
-    for remote in info["remotes"]:
-        returncode, cmd = copy_rclone(Path(mdir), mdir, remote["name"], remote["path"])
-        yield [returncode, cmd]
+    return copy_entries((Path(mdir), mdir, remote) for remote in info["remotes"])
 
 
 def copy_all(mdir):
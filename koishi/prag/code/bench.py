@@ -0,0 +1,291 @@
+import os
+import io
+import re
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+# Benchmarks indexing and retrieval against a throwaway Redis Stack (plain Redis is
+# enough with VECTOR_STORE=local), with a stub embedding server standing in for Ollama:
+#   docker run -d -p 6380:6379 redis/redis-stack-server
+#   python bench.py --redis-port 6380 --notes 2000 --queries 500
+# Settings such as CHUNK_SIZE, VECTOR_TYPE or HNSW_M are read from the environment
+# like in production, compare runs by changing them between invocations.
+# common, indexer and search are imported in main() once the environment points
+# at the benchmark Redis, notes and stub server.
+
+TOKEN_RE = re.compile(r"\w+")
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "po", "da", "fu", "gi", "ha", "ye", "bo"]
+
+class StubEmbedder:
+    """
+    Deterministic bag-of-words embeddings: every word maps to a fixed random
+    vector and a text to the normalized sum of its words, so texts sharing
+    words are close and recall is meaningful without a model.
+    """
+    def __init__(self, dim):
+        self.dim = dim
+        self.word_vectors = {}
+
+    def word_vector(self, word):
+        vector = self.word_vectors.get(word)
+        if vector is None:
+            rng = np.random.default_rng(zlib.crc32(word.encode()))
+            vector = self.word_vectors[word] = rng.standard_normal(self.dim, dtype=np.float32)
+        return vector
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in TOKEN_RE.findall(text.lower()):
+                matrix[i] += self.word_vector(word)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+def start_stub_server(embedder, latency=0.0):
+    """
+    Serves embedder as an OpenAI compatible /v1/embeddings endpoint on a
+    free local port, latency seconds are added to every request.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            texts = body["input"]
+            if isinstance(texts, str):
+                texts = [texts]
+            if latency:
+                time.sleep(latency)
+            vectors = embedder.embed(texts)
+            if body.get("encoding_format") == "base64":
+                embeddings = [base64.b64encode(vector.tobytes()).decode() for vector in vectors]
+            else:
+                embeddings = vectors.tolist()
+            payload = json.dumps({
+                "object": "list",
+                "model": body.get("model"),
+                "data": [{"object": "embedding", "index": i, "embedding": e} for i, e in enumerate(embeddings)],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_synthetic_corpus(path, notes, words_per_note, topics, rng):
+    """
+    Writes notes in topic folders. Each topic draws most words from its own
+    vocabulary, so notes of a topic are neighbours in embedding space.
+    """
+    vocabulary = sorted({"".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(5000)})
+    topic_words = [rng.sample(vocabulary, 300) for _ in range(topics)]
+    for i in range(notes):
+        topic = rng.randrange(topics)
+        lines = ["---", f"tags: [topic{topic}]", "---", f"# Note {i}", ""]
+        written = 0
+        while written < words_per_note:
+            if rng.random() < 0.2:
+                lines += [f"## {' '.join(rng.choices(topic_words[topic], k=3))}", ""]
+            length = rng.randint(30, 120)
+            words = [rng.choice(topic_words[topic]) if rng.random() < 0.8 else rng.choice(vocabulary) for _ in range(length)]
+            lines += [" ".join(words) + ".", ""]
+            written += length
+        folder = os.path.join(path, f"topic{topic}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"note{i}.md"), "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+
+def sample_corpus(source, path, notes, rng):
+    """
+    Copies up to notes random markdown files of source into path.
+    """
+    found = []
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+        found += [os.path.relpath(os.path.join(dirpath, name), source) for name in filenames if name.endswith(".md")]
+    for rel_path in rng.sample(found, min(notes, len(found))):
+        target = os.path.join(path, rel_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(os.path.join(source, rel_path), target)
+
+def make_queries(contents, count, words, rng):
+    """
+    Returns count queries made of a run of words from random chunks.
+    """
+    queries = []
+    while len(queries) < count:
+        tokens = TOKEN_RE.findall(rng.choice(contents))
+        if not tokens:
+            continue
+        start = rng.randrange(max(1, len(tokens) - words))
+        queries.append(" ".join(tokens[start:start + words]))
+    return queries
+
+def load_chunks(redis_client, scan_chunk_keys):
+    paths, contents, headings = [], [], []
+    for keys in scan_chunk_keys(1000):
+        pipeline = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hmget(key, "path", "content", "heading")
+        for path, content, heading in pipeline.execute():
+            paths.append(path)
+            contents.append(content)
+            headings.append(heading or "")
+    return paths, contents, headings
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark prag indexing throughput, query latency, memory and recall.")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--flush", action="store_true", help="Flush the Redis database first if it is not empty")
+    parser.add_argument("--corpus", help="Sample notes from this directory instead of generating them")
+    parser.add_argument("--notes", type=int, default=1000)
+    parser.add_argument("--words", type=int, default=600, help="Words per synthetic note")
+    parser.add_argument("--topics", type=int, default=20)
+    parser.add_argument("--dim", type=int, default=int(os.getenv("EMBEDDING_DIM", 1024)))
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="Seconds added to every embedding request")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--query-words", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--mode", choices=["vector", "hybrid", "lexical"], default="vector")
+    parser.add_argument("--ef-runtime", type=int, help="EF_RUNTIME of the queries, HNSW_EF_RUNTIME by default")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the indexer output")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    notes_path = tempfile.mkdtemp(prefix="prag-bench-")
+    store_path = tempfile.mkdtemp(prefix="prag-bench-vectors-")
+    if args.corpus:
+        sample_corpus(args.corpus, notes_path, args.notes, rng)
+    else:
+        write_synthetic_corpus(notes_path, args.notes, args.words, args.topics, rng)
+
+    embedder = StubEmbedder(args.dim)
+    stub = start_stub_server(embedder, args.stub_latency)
+    os.environ.update({
+        "REDIS_HOST": args.redis_host,
+        "REDIS_PORT": str(args.redis_port),
+        "NOTES_PATH": notes_path,
+        "VECTOR_STORE_PATH": store_path,
+        "EMBEDDING_BACKEND": "http",
+        "OLLAMA_API_BASE": f"http://127.0.0.1:{stub.server_port}/v1",
+        "EMBEDDING_DIM": str(args.dim),
+        # Measure embedding and search, not the caches
+        "EMBEDDING_CACHE_SIZE": "0",
+        "QUERY_CACHE_SIZE": "0"
+    })
+    import common
+    import indexer
+    import search
+
+    redis_client = common.redis_client
+    if redis_client.dbsize():
+        if not args.flush:
+            print(f"Redis at {args.redis_host}:{args.redis_port} is not empty, use a throwaway instance or pass --flush.")
+            sys.exit(1)
+        redis_client.flushdb()
+
+    try:
+        memory_before = redis_client.info("memory")["used_memory"]
+        indexer.create_index(dim=args.dim)
+        output = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+            indexer.index_notes()
+            if not common.get_vector_store().local:
+                indexer.wait_until_indexed(common.INDEX_NAME, poll_interval=0.2)
+        index_seconds = time.perf_counter() - start
+        store_stats = common.get_vector_store().stats()
+        memory_used = redis_client.info("memory")["used_memory"] - memory_before
+
+        paths, contents, headings = load_chunks(redis_client, indexer.scan_chunk_keys)
+        if not contents:
+            print("Nothing was indexed.")
+            print(output.getvalue())
+            sys.exit(1)
+        chunk_ids = {(path, content): i for i, (path, content) in enumerate(zip(paths, contents))}
+
+        # Exact float32 cosine top-k over the texts the index embedded as ground truth
+        queries = make_queries(contents, args.queries, args.query_words, rng)
+        embedded = [indexer.embedding_text(heading, content) for heading, content in zip(headings, contents)]
+        scores = embedder.embed(queries) @ embedder.embed(embedded).T
+        top_k = min(args.top_k, len(contents))
+        truth = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+
+        for query in queries[:10]:
+            search.search_notes(query, top_k=top_k, mode=args.mode, ef_runtime=args.ef_runtime)
+        latencies, recalls = [], []
+        for query, expected in zip(queries, truth):
+            start = time.perf_counter()
+            results = search.search_notes(query, top_k=top_k, mode=args.mode, ef_runtime=args.ef_runtime)
+            latencies.append(time.perf_counter() - start)
+            found = {chunk_ids.get((hit["source"], hit["content"])) for hit in results}
+            recalls.append(len(found & set(expected.tolist())) / top_k)
+    finally:
+        stub.shutdown()
+        shutil.rmtree(notes_path, ignore_errors=True)
+        shutil.rmtree(store_path, ignore_errors=True)
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    report = {
+        "settings": {
+            "chunker": common.CHUNKER,
+            "chunk_size": common.CHUNK_SIZE,
+            **({
+                "chunk_min_size": common.CHUNK_MIN_SIZE,
+                "chunk_heading_prefix": common.CHUNK_HEADING_PREFIX
+            } if common.CHUNKER == "markdown" else {"chunk_overlap": common.CHUNK_OVERLAP}),
+            "vector_store": common.VECTOR_STORE,
+            "vector_type": common.get_index_vector_type(),
+            "dim": args.dim,
+            "hnsw_m": common.HNSW_M,
+            "hnsw_ef_construction": common.HNSW_EF_CONSTRUCTION,
+            "ef_runtime": args.ef_runtime or common.HNSW_EF_RUNTIME,
+            "mode": args.mode
+        },
+        "notes": len(set(paths)),
+        "chunks": len(contents),
+        "index_seconds": round(index_seconds, 2),
+        "chunks_per_second": round(len(contents) / index_seconds, 1),
+        "query_ms": {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2)},
+        "bytes_per_chunk": {
+            "redis": round(memory_used / len(contents)),
+            "vector_index": round(store_stats["vector_index_sz_mb"] * 1024 * 1024 / len(contents))
+        },
+        f"recall_at_{top_k}": round(float(np.mean(recalls)), 4)
+    }
+
+    print(f"Settings: {', '.join(f'{name}={value}' for name, value in report['settings'].items())}")
+    print(f"Indexed {report['notes']} notes into {report['chunks']} chunks in {report['index_seconds']}s "
+          f"({report['chunks_per_second']} chunks/s)")
+    print(f"Query latency over {len(latencies)} queries: p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms")
+    print(f"Memory per chunk: {report['bytes_per_chunk']['redis']} bytes in Redis, "
+          f"{report['bytes_per_chunk']['vector_index']} bytes in the vector index")
+    print(f"Recall@{top_k} against exact cosine: {report[f'recall_at_{top_k}']:.4f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
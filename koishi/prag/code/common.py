@@ -1,38 +1,857 @@
 import os
 import sys
+import time
+import asyncio
+import re
+import json
+import base64
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
 import redis
-from openai import OpenAI
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+from openai import OpenAI, AsyncOpenAI
 
 REQUIRED_VARS = [
     "REDIS_HOST",
-    "OLLAMA_API_BASE",
     "NOTES_PATH"
 ]
+# Extra variables required by each embedding backend
+BACKEND_REQUIRED_VARS = {
+    "http": ["OLLAMA_API_BASE"],
+    "onnx": ["EMBEDDING_ONNX_MODEL"],
+}
+
+VECTOR_DTYPES = {
+    "FLOAT32": np.float32,
+    "FLOAT16": np.float16,
+    "INT8": np.int8,
+}
 
 def check_env():
-    missing = [var for var in REQUIRED_VARS if not os.getenv(var)]
+    backend = os.getenv("EMBEDDING_BACKEND", "http").lower()
+    if backend not in BACKEND_REQUIRED_VARS:
+        print(f"Error: EMBEDDING_BACKEND must be one of {', '.join(BACKEND_REQUIRED_VARS)}, got {backend}")
+        sys.exit(1)
+    missing = [var for var in REQUIRED_VARS + BACKEND_REQUIRED_VARS[backend] if not os.getenv(var)]
     if missing:
         print(f"Error: Missing required environment variables: {', '.join(missing)}")
         print("Please set them before running the script.")
         sys.exit(1)
+    vector_type = os.getenv("VECTOR_TYPE", "FLOAT32").upper()
+    if vector_type not in VECTOR_DTYPES:
+        print(f"Error: VECTOR_TYPE must be one of {', '.join(VECTOR_DTYPES)}, got {vector_type}")
+        sys.exit(1)
+    if os.getenv("CHUNKER", "markdown").lower() not in ("markdown", "recursive"):
+        print("Error: CHUNKER must be markdown or recursive")
+        sys.exit(1)
+    if os.getenv("VECTOR_STORE", "redis").lower() not in ("redis", "local"):
+        print("Error: VECTOR_STORE must be redis or local")
+        sys.exit(1)
+    if os.getenv("LARGE_FILE_POLICY", "truncate").lower() not in ("truncate", "skip"):
+        print("Error: LARGE_FILE_POLICY must be truncate or skip")
+        sys.exit(1)
 
 check_env()
 
+def available_cpus():
+    """
+    Returns the number of CPUs this process may use, honouring a cgroup v2
+    CPU limit such as the one of a Kubernetes pod.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 INDEX_NAME = os.getenv("INDEX_NAME", "prag_default")
 
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "bge-m3")
+# "markdown" splits notes along their heading tree into chunks of up to CHUNK_SIZE characters without
+# overlap, sections shorter than CHUNK_MIN_SIZE are merged with their neighbours. "recursive" cuts
+# CHUNK_SIZE character chunks sharing CHUNK_OVERLAP characters.
+CHUNKER = os.getenv("CHUNKER", "markdown").lower()
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1000))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 100))
+CHUNK_MIN_SIZE = int(os.getenv("CHUNK_MIN_SIZE", 250))
+# Embed markdown chunks prefixed with their heading path ("Project > Setup")
+CHUNK_HEADING_PREFIX = os.getenv("CHUNK_HEADING_PREFIX", "true").lower() in ("1", "true", "yes")
+# Vector dimension of EMBEDDING_MODEL. Changing either re-embeds every note on the next start.
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", 1024))
+# "http" calls the OpenAI compatible server at OLLAMA_API_BASE, "onnx" runs EMBEDDING_ONNX_MODEL
+# in process on EMBEDDING_THREADS CPU threads (needs onnxruntime and tokenizers installed)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "http").lower()
+EMBEDDING_ONNX_MODEL = os.getenv("EMBEDDING_ONNX_MODEL")
+# Defaults to the tokenizer.json next to the model
+EMBEDDING_ONNX_TOKENIZER = os.getenv("EMBEDDING_ONNX_TOKENIZER")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", 0)) or available_cpus()
+EMBEDDING_MAX_LENGTH = int(os.getenv("EMBEDDING_MAX_LENGTH", 512))
+# How token states become one vector when the model outputs them, "cls" (bge models) or "mean"
+EMBEDDING_POOLING = os.getenv("EMBEDDING_POOLING", "cls").lower()
+# "base64" ships vectors as packed float32 instead of JSON numbers, "float" for servers without it
+EMBEDDING_ENCODING_FORMAT = os.getenv("EMBEDDING_ENCODING_FORMAT", "base64").lower()
+# Where vectors are stored and searched: "redis" uses a RediSearch HNSW index and needs Redis Stack,
+# "local" searches a memory-mapped float32 matrix in VECTOR_STORE_PATH exactly and needs only
+# plain Redis (no lexical or hybrid search). Switching stores re-embeds every note on the next run.
+VECTOR_STORE = os.getenv("VECTOR_STORE", "redis").lower()
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", "vectors")
+# Storage type of indexed vectors. FLOAT16 needs Redis Stack 7.4+, INT8 needs Redis 8+.
+# Changing it or the HNSW settings on an existing index requires `python indexer.py rebuild`.
+VECTOR_TYPE = os.getenv("VECTOR_TYPE", "FLOAT32").upper()
+# HNSW graph settings applied when an index is (re)built, EF_RUNTIME can also be set per query
+HNSW_M = int(os.getenv("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", 200))
+HNSW_EF_RUNTIME = int(os.getenv("HNSW_EF_RUNTIME", 10))
+# Max number of vectors kept in the Redis embedding cache, 0 disables it. Each entry holds a float32
+# copy of a vector (4 KB at 1024 dimensions) next to the indexed one, so keep it well below the chunk count.
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 5000))
+# In-process cache of query vectors and results, entries expire after QUERY_CACHE_TTL seconds
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 1024))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", 3600))
+# Seconds to wait for a query embedding before /query falls back to lexical search
+QUERY_EMBEDDING_TIMEOUT = float(os.getenv("QUERY_EMBEDDING_TIMEOUT", 10))
+# Trade-off between relevance (1) and diversity (0) of rerank=mmr searches
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.5))
+# Parallel embedding requests while indexing, and max batches embedded or waiting to be stored
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 4))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", EMBEDDING_CONCURRENCY * 2))
+# Threads listing NOTES_PATH during a full scan, more than 1 helps on network mounts
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", 1))
+# Processes splitting notes during large runs, 0 uses every CPU available to the process
+SPLIT_WORKERS = int(os.getenv("SPLIT_WORKERS", 0)) or available_cpus()
+# Notes larger than MAX_FILE_SIZE bytes are truncated to as many characters, or skipped
+MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 10 * 1024 * 1024))
+LARGE_FILE_POLICY = os.getenv("LARGE_FILE_POLICY", "truncate").lower()
 
 OLLAMA_API_BASE = os.getenv("OLLAMA_API_BASE")
 NOTES_PATH = os.getenv("NOTES_PATH")
+# Reindex touched notes from inotify events once no event arrived for WATCH_DEBOUNCE seconds,
+# the full scan then only reconciles missed changes every FULL_SCAN_INTERVAL_HOURS
+WATCH_NOTES = os.getenv("WATCH_NOTES", "true").lower() in ("1", "true", "yes")
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 2.0))
+FULL_SCAN_INTERVAL_HOURS = float(os.getenv("FULL_SCAN_INTERVAL_HOURS", 24))
+# Seconds the index lock outlives a replica that died mid-run, renewed while a run is alive
+INDEX_LOCK_TIMEOUT = int(os.getenv("INDEX_LOCK_TIMEOUT", 60))
 
 redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+# Raw client for reading binary fields such as stored vectors
+redis_binary_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=False)
+
+# Async clients for the FastAPI query path, connections are pooled per client.
+# Pinned to RESP2 since pipelined FT.SEARCH replies are parsed from the raw RESP2 shape.
+async_redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True, protocol=2)
+async_redis_binary_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=False, protocol=2)
 
 _embed_client = OpenAI(api_key="ollama", base_url=OLLAMA_API_BASE)
+_async_embed_client = AsyncOpenAI(api_key="ollama", base_url=OLLAMA_API_BASE)
+
+INDEX_GENERATION_KEY = "prag:index:generation"  # Bumped whenever chunks are written or deleted
+INDEX_VECTOR_TYPE_KEY = "prag:index:vector_type"  # Vector type the live index was built with
+INDEX_PHYSICAL_KEY = "prag:index:physical"  # Versioned index currently behind the INDEX_NAME alias
+INDEX_VERSION_KEY = "prag:index:version"
+INDEX_STORE_KEY = "prag:index:store"  # VECTOR_STORE the chunks were indexed into
+INDEX_STORE_ID_KEY = "prag:index:store_id"  # Identity of the VECTOR_STORE_PATH the chunks were indexed into
+INDEX_EMBEDDING_KEY = "prag:index:embedding"  # EMBEDDING_MODEL and dimension the chunks were embedded with
+INDEX_LOCK_KEY = "prag:index:lock"  # Held by the replica running an indexing job
+INDEX_JOB_KEY = "prag:index:job"  # State and progress of the running or last indexing job
+EMBEDDING_CACHE_PREFIX = "prag:embcache:"
+EMBEDDING_CACHE_LRU_KEY = "prag:embcache:lru"  # ZSET of cache key -> last access time
+EMBEDDING_CACHE_STATS_KEY = "prag:embcache:stats"
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache whose entries also expire after ttl seconds.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+def escape_tag(value):
+    """
+    Escapes a value for use inside a TagField query, e.g. @path:{...}.
+    """
+    return re.sub(r"([^\w])", r"\\\1", value)
+
+def vector_field(vector_type):
+    """
+    Hash field holding vectors of the given type. Every type has its own
+    field so a migration can write the new vectors next to the old ones.
+    """
+    return "vector" if vector_type == "FLOAT32" else f"vector_{vector_type.lower()}"
+
+def encode_vectors(vectors, vector_type):
+    """
+    Converts float32 embeddings of shape (n, dim) to the stored type.
+    INT8 is a symmetric scalar quantization of the L2-normalized vector.
+    """
+    if vector_type == "INT8":
+        norms = np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+        return np.clip(np.rint(vectors / norms * 127), -127, 127).astype(np.int8)
+    return vectors.astype(VECTOR_DTYPES[vector_type], copy=False)
+
+def decode_vectors(data, vector_type):
+    """
+    Converts stored vector bytes back to a flat float32 array.
+    """
+    vectors = np.frombuffer(data, dtype=VECTOR_DTYPES[vector_type]).astype(np.float32)
+    if vector_type == "INT8":
+        vectors /= 127
+    return vectors
+
+def get_index_vector_type():
+    if VECTOR_STORE == "local":
+        # The local store keeps float32 vectors whatever VECTOR_TYPE is
+        return "FLOAT32"
+    return redis_client.get(INDEX_VECTOR_TYPE_KEY) or "FLOAT32"
+
+def get_physical_index():
+    """
+    Returns the index behind the INDEX_NAME alias. Indexes created before
+    the alias existed are named INDEX_NAME themselves.
+    """
+    return redis_client.get(INDEX_PHYSICAL_KEY) or INDEX_NAME
+
+def bump_index_generation():
+    """
+    Invalidates cached query results of every prag process.
+    """
+    redis_client.incr(INDEX_GENERATION_KEY)
+
+def renew_lock(lock, stop_event):
+    while not stop_event.wait(INDEX_LOCK_TIMEOUT / 3):
+        try:
+            lock.reacquire()
+        except LockError as e:
+            print(f"Lost the index lock: {e}")
+            return
+
+@contextmanager
+def hold_index_lock(poll_interval=5):
+    """
+    Waits until this process holds INDEX_LOCK_KEY and keeps renewing it
+    until the block exits, so indexing runs and rebuilds of all replicas
+    never overlap.
+    """
+    lock = redis_client.lock(INDEX_LOCK_KEY, timeout=INDEX_LOCK_TIMEOUT)
+    while not lock.acquire(blocking=False):
+        time.sleep(poll_interval)
+    stop_event = threading.Event()
+    renewer = threading.Thread(target=renew_lock, args=(lock, stop_event), daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop_event.set()
+        renewer.join()
+        try:
+            lock.release()
+        except LockError:
+            print("The index lock expired before its holder finished.")
 
 def call_embedding(input_data):
     if isinstance(input_data, str):
         input_data = [input_data]
-    return _embed_client.embeddings.create(input=input_data, model=EMBEDDING_MODEL)
+    return _embed_client.embeddings.create(input=input_data, model=EMBEDDING_MODEL, encoding_format=EMBEDDING_ENCODING_FORMAT)
+
+async def async_call_embedding(input_data):
+    if isinstance(input_data, str):
+        input_data = [input_data]
+    return await _async_embed_client.embeddings.create(
+        input=input_data, model=EMBEDDING_MODEL, encoding_format=EMBEDDING_ENCODING_FORMAT
+    )
+
+def embedding_text(heading, chunk):
+    """Returns the text embedded for a chunk, and the text its vector is cached under."""
+    return f"{heading}\n\n{chunk}" if heading and CHUNK_HEADING_PREFIX else chunk
+
+def embedding_cache_key(text):
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{EMBEDDING_CACHE_PREFIX}{EMBEDDING_MODEL}:{digest}"
+
+def _response_vectors(response):
+    """
+    Returns the vectors of an embeddings response as one (n, dim) float32
+    array. base64 payloads are decoded with a single np.frombuffer.
+    """
+    data = response.data
+    if data and isinstance(data[0].embedding, str):
+        packed = b"".join(base64.b64decode(emb.embedding) for emb in data)
+        return np.frombuffer(packed, dtype=np.float32).reshape(len(data), -1)
+    return np.array([emb.embedding for emb in data], dtype=np.float32)
+
+def vector_bytes(vector):
+    """
+    Returns a byte view of a vector for Redis writes, without copying it.
+    """
+    return memoryview(np.ascontiguousarray(vector)).cast("B")
+
+class HttpEmbedder:
+    """
+    Embeds texts with the OpenAI compatible embedding server at OLLAMA_API_BASE.
+    """
+    def embed(self, texts):
+        return _response_vectors(call_embedding(texts))
+
+    async def async_embed(self, texts):
+        return _response_vectors(await async_call_embedding(texts))
+
+class OnnxEmbedder:
+    """
+    Embeds texts in process with an ONNX export of the embedding model and
+    its Hugging Face tokenizer. Vectors are pooled and L2 normalized.
+    """
+    def __init__(self):
+        # Only this backend needs them, so they are not part of the Pipfile
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = EMBEDDING_THREADS
+        self.session = onnxruntime.InferenceSession(
+            EMBEDDING_ONNX_MODEL, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        tokenizer_path = EMBEDDING_ONNX_TOKENIZER or os.path.join(os.path.dirname(EMBEDDING_ONNX_MODEL), "tokenizer.json")
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(EMBEDDING_MAX_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def embed(self, texts):
+        encodings = self.tokenizer.encode_batch(list(texts))
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids)
+        }
+        output = self.session.run(None, {name: value for name, value in feeds.items() if name in self.input_names})[0]
+        if output.ndim == 3:
+            if EMBEDDING_POOLING == "mean":
+                mask = attention_mask[..., None]
+                output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+            else:
+                output = output[:, 0]
+        output = output.astype(np.float32)
+        return output / np.maximum(np.linalg.norm(output, axis=1, keepdims=True), 1e-12)
+
+    async def async_embed(self, texts):
+        # onnxruntime releases the GIL while running, a worker thread keeps the event loop free
+        return await asyncio.to_thread(self.embed, texts)
+
+EMBEDDING_BACKENDS = {
+    "http": HttpEmbedder,
+    "onnx": OnnxEmbedder,
+}
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder():
+    """
+    Returns the EMBEDDING_BACKEND embedder, created on first use.
+    """
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = EMBEDDING_BACKENDS[EMBEDDING_BACKEND]()
+        return _embedder
+
+def _decode_cached(cached):
+    return [None if value is None else np.frombuffer(value, dtype=np.float32) for value in cached]
+
+def _missing_texts(texts, vectors):
+    return list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+
+def _queue_cache_update(pipeline, keys, cached, fresh):
+    """
+    Queues storing fresh vectors, touching all looked up keys and counting
+    hits/misses. The last queued command returns the cache size.
+    """
+    now = time.time()
+    for text, vector in fresh.items():
+        pipeline.set(embedding_cache_key(text), vector_bytes(vector))
+    pipeline.zadd(EMBEDDING_CACHE_LRU_KEY, {key: now for key in keys})
+    hits = sum(1 for value in cached if value is not None)
+    pipeline.hincrby(EMBEDDING_CACHE_STATS_KEY, "hits", hits)
+    pipeline.hincrby(EMBEDDING_CACHE_STATS_KEY, "misses", len(keys) - hits)
+    pipeline.zcard(EMBEDDING_CACHE_LRU_KEY)
+
+def get_embeddings(texts):
+    """
+    Returns a float32 array of shape (len(texts), dim).
+    Texts embedded before with the same model are served from the Redis cache,
+    only the misses are sent to the embedding backend.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    if EMBEDDING_CACHE_SIZE <= 0:
+        return get_embedder().embed(texts)
+
+    keys = [embedding_cache_key(text) for text in texts]
+    cached = redis_binary_client.mget(keys)
+    vectors = _decode_cached(cached)
+
+    missing = _missing_texts(texts, vectors)
+    fresh = {}
+    if missing:
+        fresh = dict(zip(missing, get_embedder().embed(missing)))
+        vectors = [fresh[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+
+    pipeline = redis_binary_client.pipeline(transaction=False)
+    _queue_cache_update(pipeline, keys, cached, fresh)
+    size = pipeline.execute()[-1]
+    if size > EMBEDDING_CACHE_SIZE:
+        evict_embedding_cache(size - EMBEDDING_CACHE_SIZE)
+
+    return np.array(vectors, dtype=np.float32)
+
+async def async_get_embeddings(texts):
+    """
+    Async variant of get_embeddings sharing the same cache.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    if EMBEDDING_CACHE_SIZE <= 0:
+        return await get_embedder().async_embed(texts)
+
+    keys = [embedding_cache_key(text) for text in texts]
+    cached = await async_redis_binary_client.mget(keys)
+    vectors = _decode_cached(cached)
+
+    missing = _missing_texts(texts, vectors)
+    fresh = {}
+    if missing:
+        fresh = dict(zip(missing, await get_embedder().async_embed(missing)))
+        vectors = [fresh[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+
+    pipeline = async_redis_binary_client.pipeline(transaction=False)
+    _queue_cache_update(pipeline, keys, cached, fresh)
+    size = (await pipeline.execute())[-1]
+    if size > EMBEDDING_CACHE_SIZE:
+        evicted = await async_redis_client.zpopmin(EMBEDDING_CACHE_LRU_KEY, size - EMBEDDING_CACHE_SIZE)
+        if evicted:
+            await async_redis_client.unlink(*[key for key, _ in evicted])
+
+    return np.array(vectors, dtype=np.float32)
+
+def evict_embedding_cache(count):
+    """
+    Removes the least recently used entries from the embedding cache.
+    """
+    evicted = redis_client.zpopmin(EMBEDDING_CACHE_LRU_KEY, count)
+    if evicted:
+        redis_client.unlink(*[key for key, _ in evicted])
+
+def embedding_cache_stats():
+    stats = redis_client.hgetall(EMBEDDING_CACHE_STATS_KEY)
+    return {
+        "size": redis_client.zcard(EMBEDDING_CACHE_LRU_KEY),
+        "max_size": EMBEDDING_CACHE_SIZE,
+        "hits": int(stats.get("hits", 0)),
+        "misses": int(stats.get("misses", 0)),
+    }
+
+class RedisVectorStore:
+    """
+    Keeps each vector in a field of its chunk hash, where RediSearch indexes
+    it for INDEX_NAME. search.py queries it with FT.SEARCH, pipelined with
+    the full-text side of hybrid searches.
+    """
+    local = False
+
+    def put(self, pipeline, items, vector_type):
+        """
+        Queues writing (key, vector bytes, hash fields) chunks on pipeline,
+        one HSET each so RediSearch indexes every chunk once.
+        """
+        field = vector_field(vector_type)
+        for key, vector, fields in items:
+            pipeline.hset(key, mapping={**fields, field: vector})
+
+    def set_metadata(self, items):
+        # The chunk hashes already carry the metadata RediSearch filters on
+        pass
+
+    def delete(self, keys):
+        # Unlinking a chunk hash removes its vector
+        pass
+
+    def get(self, keys, vector_type):
+        pipeline = redis_binary_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(key, vector_field(vector_type))
+        return pipeline.execute()
+
+    async def async_get(self, keys, vector_type):
+        pipeline = async_redis_binary_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(key, vector_field(vector_type))
+        return await pipeline.execute()
+
+    def reset(self):
+        pass
+
+    def stats(self):
+        info = redis_client.ft(INDEX_NAME).info()
+        return {
+            "num_docs": int(info.get("num_docs", 0)),
+            "vector_index_sz_mb": float(info.get("vector_index_sz_mb", 0)),
+            "inverted_sz_mb": float(info.get("inverted_sz_mb", 0))
+        }
+
+META_FIELDS = ("path", "folder", "tags")
+
+class LocalVectorStore:
+    """
+    Exact cosine search over unit float32 vectors appended to a memory-mapped
+    file in VECTOR_STORE_PATH. Changes go to an append-only log of put, meta
+    and del records, replayed on open. Replaced and deleted vectors stay in the
+    file as dead rows until compact() rewrites both files under the next
+    generation. One process writes at a time (the index lock of jobs.py),
+    others pick up appended records and new generations when they read.
+    """
+    local = True
+    COMPACT_MIN_DEAD = 4096  # Compact once dead rows exceed this and the live rows
+
+    def __init__(self, path=VECTOR_STORE_PATH, dim=EMBEDDING_DIM):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    def files(self, generation):
+        return (
+            os.path.join(self.path, f"vectors.{generation}.f32"),
+            os.path.join(self.path, f"log.{generation}.jsonl")
+        )
+
+    def identity(self):
+        """
+        Returns the random id written into VECTOR_STORE_PATH on its first
+        use, which tells a lost or replaced directory from the one the
+        registries in Redis describe.
+        """
+        path = os.path.join(self.path, "ID")
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.path, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(uuid.uuid4().hex)
+        try:
+            # Fails if another process created it first, its id wins
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+        with open(path) as f:
+            return f.read().strip()
+
+    def read_generation(self):
+        try:
+            with open(os.path.join(self.path, "CURRENT")) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def write_generation(self, generation):
+        current = os.path.join(self.path, "CURRENT")
+        with open(current + ".tmp", "w") as f:
+            f.write(str(generation))
+        os.replace(current + ".tmp", current)
+
+    def load(self):
+        with self.lock:
+            self.generation = self.read_generation()
+            self.vectors_path, self.log_path = self.files(self.generation)
+            self.rows = {}  # key -> row of its live vector
+            self.keys = []  # row -> key
+            self.meta = []  # row -> metadata, None once dead
+            self.alive = bytearray()
+            self.matrix = None
+            self.log_offset = 0
+            self.replay()
+
+    def replay(self):
+        """
+        Applies the log records appended since the last replay.
+        """
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(self.log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line without its newline is still being written
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                self.apply(json.loads(line))
+            except ValueError:
+                print(f"Skipping corrupt record in {self.log_path}")
+        self.log_offset += end
+        if self.keys and (self.matrix is None or len(self.matrix) < len(self.keys)):
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.keys), self.dim))
+
+    def apply(self, record):
+        key = record["key"]
+        if record["op"] == "put":
+            row = record["row"]
+            while len(self.keys) <= row:
+                self.keys.append(None)
+                self.meta.append(None)
+                self.alive.append(0)
+            old = self.rows.get(key)
+            if old is not None:
+                self.alive[old] = 0
+                self.meta[old] = None
+            self.rows[key] = row
+            self.keys[row] = key
+            self.meta[row] = record["meta"]
+            self.alive[row] = 1
+        elif record["op"] == "meta":
+            row = self.rows.get(key)
+            if row is not None:
+                self.meta[row] = record["meta"]
+        elif record["op"] == "del":
+            row = self.rows.pop(key, None)
+            if row is not None:
+                self.alive[row] = 0
+                self.meta[row] = None
+
+    def refresh(self):
+        """
+        Picks up changes written by another process.
+        """
+        with self.lock:
+            if self.read_generation() != self.generation:
+                self.load()
+                return
+            try:
+                if os.path.getsize(self.log_path) > self.log_offset:
+                    self.replay()
+            except FileNotFoundError:
+                pass
+
+    def append(self, records, vectors=None):
+        """
+        Writes vectors, then the log records referring to them, and applies
+        the records. Leftovers of an interrupted write are cut off first.
+        """
+        with self.lock:
+            self.refresh()
+            if vectors is not None:
+                with open(self.vectors_path, "ab") as f:
+                    f.truncate(f.tell() - f.tell() % self.row_bytes)
+                    f.write(vectors.tobytes())
+            with open(self.log_path, "ab") as f:
+                f.truncate(self.log_offset)
+                f.write(b"".join(json.dumps(record).encode() + b"\n" for record in records))
+            self.replay()
+            if self.dead_rows() > max(self.COMPACT_MIN_DEAD, len(self.rows)):
+                self.compact()
+
+    def dead_rows(self):
+        return len(self.keys) - len(self.rows)
+
+    def put(self, pipeline, items, vector_type):
+        """
+        Queues writing the hash fields of (key, vector bytes, hash fields)
+        chunks on pipeline and stores their vectors right away, with the
+        metadata searches filter on.
+        """
+        if not items:
+            return
+        for key, _, fields in items:
+            pipeline.hset(key, mapping=fields)
+        vectors = np.stack([decode_vectors(vector, vector_type) for _, vector, _ in items])
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"Got {vectors.shape[1]}-dimensional vectors, VECTOR_STORE_PATH holds {self.dim} (EMBEDDING_DIM)")
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        with self.lock:
+            self.refresh()
+            try:
+                first_row = os.path.getsize(self.vectors_path) // self.row_bytes
+            except FileNotFoundError:
+                first_row = 0
+            records = [
+                {"op": "put", "key": key, "row": first_row + i, "meta": {name: fields[name] for name in META_FIELDS}}
+                for i, (key, _, fields) in enumerate(items)
+            ]
+            self.append(records, vectors)
+
+    def set_metadata(self, items):
+        """
+        Updates the metadata of stored (key, metadata) items where it changed,
+        such as the tags of unchanged chunks.
+        """
+        with self.lock:
+            self.refresh()
+            records = [
+                {"op": "meta", "key": key, "meta": metadata}
+                for key, metadata in items
+                if key in self.rows and self.meta[self.rows[key]] != metadata
+            ]
+            if records:
+                self.append(records)
+
+    def delete(self, keys):
+        with self.lock:
+            self.refresh()
+            records = [{"op": "del", "key": key} for key in keys if key in self.rows]
+            if records:
+                self.append(records)
+
+    def get(self, keys, vector_type):
+        """
+        Returns the stored float32 bytes of each key, None for missing keys.
+        """
+        with self.lock:
+            self.refresh()
+            rows = [self.rows.get(key) for key in keys]
+            return [None if row is None else self.matrix[row].tobytes() for row in rows]
+
+    async def async_get(self, keys, vector_type):
+        return self.get(keys, vector_type)
+
+    def search(self, vector, top_k, path_prefix=None, folder=None, tags=None):
+        """
+        Returns up to top_k (key, cosine similarity) pairs, best first, of the
+        vectors whose metadata matches the scopes of search.build_filter.
+        """
+        with self.lock:
+            self.refresh()
+            if not self.rows:
+                return []
+            matrix, keys, meta = self.matrix, self.keys, self.meta
+            mask = np.frombuffer(self.alive, dtype=np.bool_).copy()
+            if path_prefix or folder or tags:
+                tags = set(tags or ())
+                mask &= np.fromiter((
+                    m is not None
+                    and (not path_prefix or m["path"].startswith(path_prefix))
+                    and (not folder or m["folder"] == folder)
+                    and (not tags or not tags.isdisjoint(m["tags"].split(",")))
+                    for m in meta
+                ), dtype=np.bool_, count=len(meta))
+
+        # Every row in one product, dead and filtered out rows are masked afterwards
+        scores = matrix @ (np.asarray(vector, dtype=np.float32) / max(np.linalg.norm(vector), 1e-12))
+        scores[~mask] = -np.inf
+        top_k = min(top_k, int(mask.sum()))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(keys[row], float(scores[row])) for row in best]
+
+    def compact(self):
+        """
+        Rewrites the live rows under the next generation and drops the files
+        of the current one.
+        """
+        with self.lock:
+            generation = self.generation + 1
+            vectors_path, log_path = self.files(generation)
+            live = sorted(self.rows.values())
+            with open(vectors_path, "wb") as f:
+                for start in range(0, len(live), 4096):
+                    f.write(np.ascontiguousarray(self.matrix[live[start:start + 4096]]).tobytes())
+            with open(log_path, "wb") as f:
+                for new_row, row in enumerate(live):
+                    record = {"op": "put", "key": self.keys[row], "row": new_row, "meta": self.meta[row]}
+                    f.write(json.dumps(record).encode() + b"\n")
+            old_files = (self.vectors_path, self.log_path)
+            self.write_generation(generation)
+            self.load()
+            for path in old_files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            print(f"Compacted {VECTOR_STORE_PATH}: {len(self.rows)} vectors kept.")
+
+    def reset(self):
+        """
+        Starts an empty generation, for indexing everything again.
+        """
+        with self.lock:
+            old_files = self.files(self.generation)
+            self.write_generation(self.generation + 1)
+            self.load()
+            for path in old_files:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            self.refresh()
+            try:
+                size = os.path.getsize(self.vectors_path)
+            except FileNotFoundError:
+                size = 0
+            return {
+                "num_docs": len(self.rows),
+                "vector_index_sz_mb": size / (1024 * 1024),
+                "dead_rows": self.dead_rows()
+            }
+
+VECTOR_STORES = {
+    "redis": RedisVectorStore,
+    "local": LocalVectorStore,
+}
+_vector_store = None
+_vector_store_lock = threading.Lock()
+
+def get_vector_store():
+    """
+    Returns the VECTOR_STORE vector store, created on first use.
+    """
+    global _vector_store
+    with _vector_store_lock:
+        if _vector_store is None:
+            _vector_store = VECTOR_STORES[VECTOR_STORE]()
+        return _vector_store
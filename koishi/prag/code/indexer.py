@@ -1,48 +1,254 @@
-import glob
+import hashlib
+import itertools
+import multiprocessing
 import os
-import numpy as np
+import re
+import sys
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from redis.commands.search.field import VectorField, TextField, TagField
 from redis.commands.search.index_definition import IndexDefinition, IndexType
 from redis.commands.search.query import Query
-from common import redis_client, INDEX_NAME, NOTES_PATH, call_embedding
+from redis.exceptions import ResponseError
+import metrics
+from common import (
+    redis_client, redis_binary_client, INDEX_NAME, INDEX_GENERATION_KEY, NOTES_PATH,
+    EMBEDDING_CONCURRENCY, EMBEDDING_MAX_IN_FLIGHT, SCAN_WORKERS, SPLIT_WORKERS,
+    MAX_FILE_SIZE, LARGE_FILE_POLICY, EMBEDDING_DIM, CHUNK_SIZE, CHUNK_OVERLAP, VECTOR_TYPE, INDEX_VECTOR_TYPE_KEY,
+    CHUNKER, CHUNK_MIN_SIZE, CHUNK_HEADING_PREFIX,
+    HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_RUNTIME, INDEX_PHYSICAL_KEY, INDEX_VERSION_KEY,
+    VECTOR_STORE, INDEX_STORE_KEY, INDEX_STORE_ID_KEY, INDEX_EMBEDDING_KEY, EMBEDDING_MODEL, hold_index_lock, get_vector_store, get_embeddings, bump_index_generation, escape_tag, embedding_cache_key, embedding_text,
+    vector_field, encode_vectors, decode_vectors, vector_bytes, get_index_vector_type, get_physical_index
+)
 
 REGISTRY_KEY = "prag:registry:mtime"
+CHUNK_REGISTRY_PREFIX = "prag:registry:chunks:"  # Per-file hash of chunk index -> content digest
+METADATA_REGISTRY_KEY = "prag:registry:metadata"  # File -> digest of the metadata stored on its chunks
 BATCH_SIZE = 32  # Number of chunks to embed and store in one batch
+REGISTRY_BATCH_SIZE = 1000  # Number of deleted files removed per pipeline
+SPLIT_WINDOW = 1024 * 1024  # Characters read and split at once
+SPLIT_POOL_MIN_FILES = 64  # Smaller runs are split inline, starting worker processes costs more
+# A closing # sequence only counts after whitespace, "## C#" is titled C#
+HEADING_RE = re.compile(r"^(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*$")
+FENCE_RE = re.compile(r"^[ \t]*(```|~~~)")
+
+# Serializes full scans and watcher updates within the process
+index_lock = threading.Lock()
 
 def get_rel_path(abs_path):
     """Returns the path relative to NOTES_PATH."""
     return os.path.relpath(abs_path, NOTES_PATH)
 
-def create_index(dim=1024):
+def chunk_key(rel_path, idx):
+    return f"prag:default:{rel_path}:{idx}"
+
+def chunk_registry_key(rel_path):
+    return f"{CHUNK_REGISTRY_PREFIX}{rel_path}"
+
+def chunk_digest(text, heading=""):
+    if heading:
+        # Stored with the chunk and possibly embedded with it, a new heading is a new chunk
+        text = f"{heading}\0{CHUNK_HEADING_PREFIX}\0{text}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def metadata_digest(metadata):
+    text = "\0".join(f"{name}={value}" for name, value in sorted(metadata.items()))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def get_folder(rel_path):
+    """Returns the top-level folder of a note, empty for notes at the root."""
+    parts = rel_path.split(os.sep)
+    return parts[0] if len(parts) > 1 else ""
+
+def parse_frontmatter_tags(content):
+    """
+    Returns the tags listed in the YAML frontmatter of a note, either inline
+    (tags: [a, b] / tags: a, b) or as a block list (tags:\n  - a).
+    """
+    if not content.startswith("---"):
+        return []
+    end = content.find("\n---", 3)
+    if end == -1:
+        return []
+
+    tags = []
+    in_tags = False
+    for line in content[3:end].splitlines():
+        stripped = line.strip()
+        if in_tags and stripped.startswith("- "):
+            tags.append(stripped[2:])
+            continue
+        in_tags = False
+        key, sep, value = stripped.partition(":")
+        if not sep or key not in ("tags", "tag"):
+            continue
+        value = value.strip().strip("[]")
+        if value:
+            tags.extend(value.split(",") if "," in value else value.split())
+        else:
+            in_tags = True
+
+    tags = [tag.strip().strip("\"'").lstrip("#") for tag in tags]
+    return list(dict.fromkeys(tag for tag in tags if tag))
+
+def is_unknown_index(error):
+    # "Unknown Index name" before RediSearch 8, "<name>: no such index" since
+    message = str(error).lower()
+    return isinstance(error, ResponseError) and ("unknown index" in message or "no such index" in message)
+
+def index_attributes():
+    """Returns the attribute names of the current index schema."""
+    info = redis_client.ft(INDEX_NAME).info()
+    names = set()
+    for attribute in info.get("attributes", []):
+        attribute = [str(item) for item in attribute]
+        if "attribute" in attribute:
+            names.add(attribute[attribute.index("attribute") + 1])
+    return names
+
+def build_schema(vector_type, dim):
+    return (
+        TextField("content"),
+        TagField("path"),
+        TagField("folder"),
+        TagField("tags"),
+        VectorField(vector_field(vector_type), "HNSW", {
+            "TYPE": vector_type,
+            "DIM": dim,
+            "DISTANCE_METRIC": "COSINE",
+            "M": HNSW_M,
+            "EF_CONSTRUCTION": HNSW_EF_CONSTRUCTION,
+            "EF_RUNTIME": HNSW_EF_RUNTIME
+        }, as_name="vector")
+    )
+
+def create_physical_index(vector_type, dim):
+    """
+    Creates a new versioned index over all chunks and returns its name.
+    """
+    name = f"{INDEX_NAME}_v{redis_client.incr(INDEX_VERSION_KEY)}"
+    redis_client.ft(name).create_index(
+        build_schema(vector_type, dim),
+        definition=IndexDefinition(prefix=["prag:default:"], index_type=IndexType.HASH)
+    )
+    return name
+
+def reset_chunks():
+    """
+    Deletes every chunk, both registries and the stored vectors, so the next
+    run indexes all notes again.
+    """
+    for pattern in ("prag:default:*", f"{CHUNK_REGISTRY_PREFIX}*"):
+        keys = []
+        for key in redis_client.scan_iter(match=pattern, count=REGISTRY_BATCH_SIZE):
+            keys.append(key)
+            if len(keys) == REGISTRY_BATCH_SIZE:
+                redis_client.unlink(*keys)
+                keys = []
+        if keys:
+            redis_client.unlink(*keys)
+    redis_client.delete(REGISTRY_KEY, METADATA_REGISTRY_KEY)
+    get_vector_store().reset()
+    bump_index_generation()
+
+def drop_index():
+    """
+    Drops the live index and its alias, the chunks are kept.
+    """
     try:
-        redis_client.ft(INDEX_NAME).info()
+        redis_client.ft(INDEX_NAME).aliasdel(INDEX_NAME)
+    except ResponseError:
+        # Indexes created before the alias existed own the name
+        pass
+    try:
+        redis_client.ft(get_physical_index()).dropindex(delete_documents=False)
+    except ResponseError as e:
+        if not is_unknown_index(e):
+            raise
+
+def check_local_store(store):
+    """
+    Indexes every note again when VECTOR_STORE_PATH is not the directory the
+    registries were written for, such as after a restart without a volume.
+    Otherwise unchanged notes are never embedded into the new directory.
+    """
+    store_id = store.identity()
+    indexed_id = redis_client.get(INDEX_STORE_ID_KEY)
+    lost = indexed_id is not None and indexed_id != store_id
+    if not lost and store.stats()["num_docs"] == 0:
+        # Registered chunks without vectors, also covers installs from before the id existed
+        lost = next(redis_client.scan_iter(match=f"{CHUNK_REGISTRY_PREFIX}*", count=REGISTRY_BATCH_SIZE), None) is not None
+    if lost:
+        print(f"{store.path} does not hold the indexed vectors, indexing every note again.")
+        reset_chunks()
+    redis_client.set(INDEX_STORE_ID_KEY, store_id)
+
+def create_index(dim=EMBEDDING_DIM):
+    # Installs from before VECTOR_STORE existed indexed into Redis
+    indexed_store = redis_client.get(INDEX_STORE_KEY) or ("redis" if redis_client.exists(REGISTRY_KEY) else VECTOR_STORE)
+    embedding = f"{EMBEDDING_MODEL}:{dim}"
+    # Installs from before the key existed are assumed to use the current model
+    indexed_embedding = redis_client.get(INDEX_EMBEDDING_KEY) or embedding
+    if indexed_store != VECTOR_STORE:
+        print(f"Notes were indexed into the {indexed_store} vector store, indexing them again into {VECTOR_STORE}.")
+        reset_chunks()
+    elif indexed_embedding != embedding:
+        # Vectors of two models do not compare, and the index schema fixes the dimension
+        print(f"Notes were embedded with {indexed_embedding}, embedding them again with {embedding}.")
+        reset_chunks()
+        if not get_vector_store().local:
+            drop_index()
+    redis_client.mset({INDEX_STORE_KEY: VECTOR_STORE, INDEX_EMBEDDING_KEY: embedding})
+    store = get_vector_store()
+    if store.local:
+        check_local_store(store)
+        return
+
+    try:
+        attributes = index_attributes()
         print(f"Index {INDEX_NAME} already exists.")
-    except Exception as e:
-        print(f"Index not found or error: {e}. Creating new index...")
-        schema = (
-            TextField("content"),
-            TagField("path"),
-            VectorField("vector", "HNSW", {
-                "TYPE": "FLOAT32",
-                "DIM": dim,
-                "DISTANCE_METRIC": "COSINE"
-            })
-        )
-        redis_client.ft(INDEX_NAME).create_index(
-            schema, 
-            definition=IndexDefinition(prefix=["prag:default:"], index_type=IndexType.HASH)
-        )
-        print(f"Created index {INDEX_NAME}.")
+    except ResponseError as e:
+        if not is_unknown_index(e):
+            raise
+        print(f"Index {INDEX_NAME} not found. Creating new index...")
+        name = create_physical_index(VECTOR_TYPE, dim)
+        try:
+            redis_client.ft(name).aliasadd(INDEX_NAME)
+        except ResponseError as e:
+            # Another replica created the index meanwhile, do not leave a second one behind
+            redis_client.ft(name).dropindex(delete_documents=False)
+            print(f"Dropped {name}, {INDEX_NAME} was created by another process: {e}")
+            return
+        redis_client.mset({INDEX_PHYSICAL_KEY: name, INDEX_VECTOR_TYPE_KEY: VECTOR_TYPE})
+        print(f"Created index {name} with {VECTOR_TYPE} vectors, aliased as {INDEX_NAME}.")
+        return
+
+    index_vector_type = get_index_vector_type()
+    if index_vector_type != VECTOR_TYPE:
+        print(f"Index {INDEX_NAME} stores {index_vector_type} vectors but VECTOR_TYPE is {VECTOR_TYPE}, "
+              f"keeping {index_vector_type} until `python indexer.py rebuild` is run.")
 
-def delete_file_chunks(rel_path):
+    missing = [field for field in ("folder", "tags") if field not in attributes]
+    if missing:
+        redis_client.ft(get_physical_index()).alter_schema_add([TagField(field) for field in missing])
+        # Revisit every file so existing chunks get the new fields, no re-embedding is needed
+        redis_client.delete(REGISTRY_KEY, METADATA_REGISTRY_KEY)
+        print(f"Added {', '.join(missing)} to index {INDEX_NAME}, all notes will be revisited.")
+
+def search_delete_chunks(rel_path):
     """
-    Deletes all chunks associated with a specific relative file path from the index.
+    Deletes the chunks of a file indexed before the chunk registry existed
+    by searching the index for its path.
     """
-    # Escaping special characters for TagField query
-    escaped_path = rel_path.replace("-", "\\-").replace(".", "\\.").replace("_", "\\_").replace("/", "\\/")
-    query_str = f"@path:{{{escaped_path}}}"
+    if get_vector_store().local:
+        # Local stores were filled after the chunk registry existed, and plain Redis cannot search
+        return
+    query_str = f"@path:{{{escape_tag(rel_path)}}}"
     
     while True:
         query = Query(query_str).return_fields("id").paging(0, 1000).dialect(2)
@@ -55,92 +261,712 @@ def delete_file_chunks(rel_path):
         if len(results.docs) < 1000:
             break
 
-def process_file_in_batches(abs_path, splitter):
+def delete_file_chunks(rel_paths):
     """
-    Reads a file and yields batches of chunks.
+    Unlinks every chunk of the given files in one pipeline, the chunk
+    registry of each file lists its chunk indices. Files indexed before the
+    chunk registry existed fall back to search_delete_chunks.
     """
+    pipeline = redis_client.pipeline(transaction=False)
+    for rel_path in rel_paths:
+        pipeline.hkeys(chunk_registry_key(rel_path))
+    indices_per_file = pipeline.execute()
+
+    legacy, keys = [], []
+    for rel_path, indices in zip(rel_paths, indices_per_file):
+        if indices:
+            keys += [chunk_key(rel_path, idx) for idx in indices]
+        else:
+            legacy.append(rel_path)
+    if keys:
+        pipeline.unlink(*keys)
+        pipeline.execute()
+        get_vector_store().delete(keys)
+    for rel_path in legacy:
+        search_delete_chunks(rel_path)
+
+_splitter = None
+
+def iter_chunks(f, splitter, limit):
+    """
+    Yields the chunks of an open note, reading at most limit characters in
+    windows of SPLIT_WINDOW characters. The last chunk of a window is split
+    again together with the next window, so window boundaries do not cut
+    chunks and the overlap between chunks is kept.
+    """
+    carry = ""
+    while limit > 0:
+        window = f.read(min(SPLIT_WINDOW, limit))
+        if not window:
+            break
+        limit -= len(window)
+        text = carry + window
+        chunks = splitter.split_text(text)
+        if not chunks:
+            carry = ""
+            continue
+        yield from chunks[:-1]
+        carry = text[text.rfind(chunks[-1]):]
+    if carry:
+        yield from splitter.split_text(carry)
+
+def read_lines(f, limit):
+    """
+    Yields the lines of an open note up to limit characters. Reads are
+    bounded too, a note without newlines is not loaded whole.
+    """
+    while limit > 0:
+        line = f.readline(limit)
+        if not line:
+            return
+        yield line
+        limit -= len(line)
+
+def iter_sections(lines):
+    """
+    Yields (heading titles, heading line, body) for every section of a note,
+    the titles being the path from the top-level heading down. Frontmatter
+    is skipped and # lines inside fenced code blocks are not headings.
+    """
+    lines = iter(lines)
+    head = list(itertools.islice(lines, 1))
+    if head and head[0].rstrip() == "---":
+        for line in lines:
+            head.append(line)
+            if line.rstrip() == "---":
+                head = []
+                break
+        # Without a closing ---, the note only starts with a rule and head holds all of it
+
+    path, heading_line, body = (), "", []
+    fence = None
+    for line in itertools.chain(head, lines):
+        match = FENCE_RE.match(line)
+        if match:
+            fence = None if fence == match.group(1) else fence or match.group(1)
+        match = None if fence else HEADING_RE.match(line.rstrip("\n"))
+        if match:
+            yield path, heading_line, "".join(body).strip()
+            level = len(match.group(1))
+            # Skipped levels (# then ###) keep their parent
+            path = path[:level - 1] + (match.group(2),)
+            heading_line, body = line.rstrip("\n"), []
+        else:
+            body.append(line)
+    yield path, heading_line, "".join(body).strip()
+
+def common_path(paths):
+    common = paths[0]
+    for path in paths[1:]:
+        size = 0
+        while size < min(len(common), len(path)) and common[size] == path[size]:
+            size += 1
+        common = common[:size]
+    return common
+
+def pack_sections(parts):
+    """
+    Returns (heading, text) for sections packed into one chunk. Below the
+    heading path they share, each section is preceded by the heading lines
+    that differ from the previous section's, so the text keeps the outline.
+    """
+    path = common_path([part_path for part_path, _, _ in parts])
+    texts = []
+    previous = path
+    for part_path, line, body in parts:
+        shared = len(common_path([previous, part_path]))
+        headings = [f"{'#' * (level + 1)} {title}" for level, title in enumerate(part_path[:-1]) if level >= shared]
+        if len(part_path) > shared:
+            headings.append(line)
+        texts.append("\n".join(headings + [body]))
+        previous = part_path
+    return " > ".join(path), "\n\n".join(texts)
+
+def iter_markdown_chunks(lines, splitter):
+    """
+    Yields (heading, chunk) following the heading tree of a note. A section
+    becomes one chunk, a section longer than CHUNK_SIZE is cut by splitter,
+    and a section shorter than CHUNK_MIN_SIZE is merged with its neighbours
+    while the merged chunk fits CHUNK_SIZE.
+    """
+    parts, size = [], 0
+    for path, line, body in iter_sections(lines):
+        if not body:
+            # The title lives on in the paths of its subsections
+            continue
+        if len(body) > CHUNK_SIZE:
+            if parts:
+                yield pack_sections(parts)
+                parts, size = [], 0
+            heading = " > ".join(path)
+            for chunk in splitter.split_text(body):
+                yield heading, chunk
+            continue
+        length = len(line) + len(body) + 2
+        if parts and (size < CHUNK_MIN_SIZE or length < CHUNK_MIN_SIZE) and size + length <= CHUNK_SIZE:
+            parts.append((path, line, body))
+            size += length
+            continue
+        if parts:
+            yield pack_sections(parts)
+        parts, size = [(path, line, body)], length
+    if parts:
+        yield pack_sections(parts)
+
+def read_chunks(abs_path):
+    """
+    Reads a file and returns (chunks, their headings, frontmatter tags), or
+    None if it cannot be read. Headings are empty with CHUNKER=recursive.
+    Files are read as a stream and capped by MAX_FILE_SIZE, a file above it
+    is either truncated or, with LARGE_FILE_POLICY=skip, indexed without
+    chunks. Also runs in the split worker processes, each keeps its own splitter.
+    """
+    global _splitter
+    if _splitter is None:
+        _splitter = make_splitter()
     try:
+        limit = MAX_FILE_SIZE
+        size = os.path.getsize(abs_path)
+        if size > MAX_FILE_SIZE:
+            print(f"{abs_path} is {size} bytes, over MAX_FILE_SIZE, {'skipping' if LARGE_FILE_POLICY == 'skip' else 'truncating'}")
+            if LARGE_FILE_POLICY == "skip":
+                limit = 0
         with open(abs_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            chunks = splitter.split_text(content)
-            
-            for i in range(0, len(chunks), BATCH_SIZE):
-                yield chunks[i:i + BATCH_SIZE], i
+            tags = parse_frontmatter_tags(f.read(min(SPLIT_WINDOW, limit)))
+            f.seek(0)
+            if CHUNKER == "recursive":
+                chunks = list(iter_chunks(f, _splitter, limit))
+                return chunks, [""] * len(chunks), tags
+            pairs = list(iter_markdown_chunks(read_lines(f, limit), _splitter))
+            return [chunk for _, chunk in pairs], [heading for heading, _ in pairs], tags
     except Exception as e:
         print(f"Error reading {abs_path}: {e}")
+        return None
+
+class FileJob:
+    """
+    Tracks one changed file while its chunks move through the indexing pipeline.
+    The file is finalized once all of its pending chunk writes are done.
+    """
+    def __init__(self, rel_path, mtime, metadata, metadata_changed, headings, digests, unchanged, stale_keys):
+        self.rel_path = rel_path
+        self.mtime = mtime
+        self.metadata = metadata
+        self.metadata_changed = metadata_changed
+        self.headings = headings
+        self.digests = digests
+        self.unchanged = unchanged
+        self.stale_keys = stale_keys
+        self.stats = {}
+        self.pending = 0
+        self.failed = False
+
+def split_files(abs_paths):
+    """
+    Yields read_chunks(abs_path) for each path, in order. Large runs are split
+    by SPLIT_WORKERS processes, which stay at most a few files ahead of the
+    consumer so a slow embedding stage bounds memory.
+    """
+    if SPLIT_WORKERS <= 1 or len(abs_paths) < SPLIT_POOL_MIN_FILES:
+        for abs_path in abs_paths:
+            yield read_chunks(abs_path)
         return
 
-def cleanup_deleted_files(all_rel_paths_on_disk):
+    # Spawned rather than forked, the indexing process already runs threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=SPLIT_WORKERS, mp_context=context) as executor:
+        paths = iter(abs_paths)
+        ahead = deque(executor.submit(read_chunks, abs_path) for abs_path in itertools.islice(paths, SPLIT_WORKERS * 4))
+        while ahead:
+            read = ahead.popleft().result()
+            for abs_path in itertools.islice(paths, 1):
+                ahead.append(executor.submit(read_chunks, abs_path))
+            yield read
+
+def plan_file(rel_path, mtime, chunks, headings, tags, vector_type):
+    """
+    Diffs the chunks of a file against the chunk registry.
+    Returns (job, chunks to embed, records with reused vectors). Unchanged
+    chunks get their metadata refreshed when the file is finalized if it
+    changed, chunks that moved to another position reuse their stored vector.
+    """
+    metadata = {"path": rel_path, "folder": get_folder(rel_path), "tags": ",".join(tags)}
+
+    registry_key = chunk_registry_key(rel_path)
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.hgetall(registry_key)
+    pipeline.hget(METADATA_REGISTRY_KEY, rel_path)
+    old_chunks, old_metadata = pipeline.execute()
+    old_digests = {int(idx): digest for idx, digest in old_chunks.items()}
+    if not old_digests:
+        # New, or indexed before the chunk registry existed. The file registry cannot
+        # tell these apart since create_index may have cleared it, so start clean.
+        search_delete_chunks(rel_path)
+
+    old_idx_by_digest = {}
+    for idx, digest in old_digests.items():
+        old_idx_by_digest.setdefault(digest, idx)
+
+    digests = [chunk_digest(chunk, heading) for chunk, heading in zip(chunks, headings)]
+    unchanged = []
+    to_embed = []
+    to_rekey = {}  # new idx -> old idx holding the same content
+    for idx, digest in enumerate(digests):
+        if old_digests.get(idx) == digest:
+            unchanged.append(idx)
+            continue
+        if digest in old_idx_by_digest:
+            to_rekey[idx] = old_idx_by_digest[digest]
+        else:
+            to_embed.append(idx)
+
+    if to_embed or to_rekey:
+        # Blank the digests of the chunks about to be overwritten, so an interrupted
+        # run re-embeds them next time while the registry still lists every key
+        redis_client.hset(registry_key, mapping={str(idx): "" for idx in [*to_embed, *to_rekey]})
+
+    stale_keys = [chunk_key(rel_path, idx) for idx in old_digests if idx >= len(chunks)]
+    metadata_changed = old_metadata != metadata_digest(metadata)
+    job = FileJob(rel_path, mtime, metadata, metadata_changed, headings, digests, unchanged, stale_keys)
+
+    # Read every reused vector before anything of this file is overwritten
+    rekeyed = []
+    if to_rekey:
+        old_keys = [chunk_key(rel_path, old_idx) for old_idx in to_rekey.values()]
+        for idx, vector in zip(list(to_rekey), get_vector_store().get(old_keys, vector_type)):
+            if vector is None:
+                to_embed.append(idx)
+            else:
+                rekeyed.append((job, idx, chunks[idx], vector))
+        to_embed.sort()
+
+    job.stats["embedded"] = len(to_embed)
+    job.stats["reused"] = len(rekeyed)
+    job.pending = len(to_embed) + len(rekeyed)
+    return job, [(job, idx, chunks[idx]) for idx in to_embed], rekeyed
+
+def finalize_file(job):
     """
-    Removes files from the index and registry that no longer exist on disk.
-    Uses relative paths.
+    Removes stale chunk keys and records the file in both registries.
+    A failed file keeps its old mtime so the next run retries it.
     """
-    registry = redis_client.hgetall(REGISTRY_KEY)
-    if not registry:
+    if job.failed:
+        # Some of its chunks may have been written already
+        bump_index_generation()
+        print(f"Failed: {job.rel_path}, will retry on the next run")
         return
-        
-    all_files_set = set(all_rel_paths_on_disk)
-    for rel_path in registry:
-        if rel_path not in all_files_set:
+
+    registry_key = chunk_registry_key(job.rel_path)
+    pipeline = redis_client.pipeline()
+    # Every HSET makes RediSearch index the chunk again, vector included
+    refreshed = job.unchanged if job.metadata_changed else []
+    for idx in refreshed:
+        pipeline.hset(chunk_key(job.rel_path, idx), mapping=job.metadata)
+    if job.stale_keys:
+        pipeline.unlink(*job.stale_keys)
+    pipeline.delete(registry_key)
+    if job.digests:
+        pipeline.hset(registry_key, mapping={str(idx): digest for idx, digest in enumerate(job.digests)})
+    # Update registry with relative path
+    pipeline.hset(REGISTRY_KEY, job.rel_path, job.mtime)
+    pipeline.hset(METADATA_REGISTRY_KEY, job.rel_path, metadata_digest(job.metadata))
+    pipeline.incr(INDEX_GENERATION_KEY)
+    with metrics.redis_pipeline_seconds.time(stage="finalize"):
+        pipeline.execute()
+    store = get_vector_store()
+    store.set_metadata([(chunk_key(job.rel_path, idx), job.metadata) for idx in refreshed])
+    store.delete(job.stale_keys)
+    print(f"Finished: {job.rel_path} ({job.stats['embedded']} embedded, {job.stats['reused']} reused, "
+          f"{len(job.unchanged)} unchanged, {len(job.stale_keys)} removed)")
+
+def embed_worker(embed_queue, write_queue, vector_type, progress=None):
+    """
+    Embeds batches of (job, idx, chunk) and hands the vectors to the writer.
+    """
+    while True:
+        batch = embed_queue.get()
+        if batch is None:
+            break
+        try:
+            with metrics.embedding_batch_seconds.time():
+                embeddings = get_embeddings([embedding_text(job.headings[idx], chunk) for job, idx, chunk in batch])
+            # Byte views into the batch array, sent to Redis without per-vector copies
+            vectors = [vector_bytes(vector) for vector in encode_vectors(embeddings, vector_type)]
+            metrics.chunks_embedded.inc(len(batch))
+            if progress:
+                progress.add("chunks_embedded", len(batch))
+        except Exception as e:
+            print(f"Error embedding batch: {e}")
+            metrics.embedding_errors.inc()
+            vectors = [None] * len(batch)
+        write_queue.put(([(job, idx, chunk, vector) for (job, idx, chunk), vector in zip(batch, vectors)], True))
+
+def write_worker(write_queue, in_flight, vector_type, progress=None):
+    """
+    Stores chunk records in one pipeline per batch and finalizes every file
+    whose last pending chunk was written.
+    """
+    store = get_vector_store()
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+        records, from_embedding = item
+        try:
+            pipeline = redis_client.pipeline()
+            items = []
+            for job, idx, chunk, vector in records:
+                if idx is None:
+                    continue
+                if vector is None:
+                    job.failed = True
+                    continue
+                # doc_id also uses relative path to be consistent
+                fields = {**job.metadata, "content": chunk, "heading": job.headings[idx]}
+                items.append((chunk_key(job.rel_path, idx), vector, fields))
+            store.put(pipeline, items, vector_type)
+            with metrics.redis_pipeline_seconds.time(stage="write"):
+                pipeline.execute()
+        except Exception as e:
+            print(f"Error storing batch: {e}")
+            for job, _, _, _ in records:
+                job.failed = True
+
+        for job, _, _, _ in records:
+            job.pending -= 1
+            if job.pending == 0:
+                try:
+                    finalize_file(job)
+                except Exception as e:
+                    print(f"Error finalizing {job.rel_path}: {e}")
+                if progress:
+                    progress.add("files_done")
+        if from_embedding:
+            in_flight.release()
+
+def run_pipeline(changed_files, progress=None):
+    """
+    Indexes (rel_path, abs_path, mtime) entries with a splitting stage (see
+    split_files), a planning stage in the calling thread,
+    EMBEDDING_CONCURRENCY embedding workers and one Redis writer. Chunks of several files are packed into the same embedding batch,
+    and at most EMBEDDING_MAX_IN_FLIGHT batches are embedded or waiting to be
+    written at any time, so a slow stage holds back the planning stage.
+    progress, when given, is told about files_done and chunks_embedded.
+    """
+    embed_queue = queue.Queue()
+    write_queue = queue.Queue()
+    in_flight = threading.BoundedSemaphore(EMBEDDING_MAX_IN_FLIGHT)
+    # Write what the live index reads, VECTOR_TYPE only takes effect after a migration
+    vector_type = get_index_vector_type()
+
+    embedders = [
+        threading.Thread(target=embed_worker, args=(embed_queue, write_queue, vector_type, progress), daemon=True)
+        for _ in range(EMBEDDING_CONCURRENCY)
+    ]
+    writer = threading.Thread(target=write_worker, args=(write_queue, in_flight, vector_type, progress), daemon=True)
+    for thread in embedders + [writer]:
+        thread.start()
+
+    def submit(batch):
+        in_flight.acquire()
+        embed_queue.put(batch)
+
+    batch = []
+    try:
+        reads = split_files([abs_path for _, abs_path, _ in changed_files])
+        for (rel_path, _, mtime), read in zip(changed_files, reads):
+            print(f"Indexing: {rel_path}")
+            if read is None:
+                if progress:
+                    progress.add("files_done")
+                continue
+            try:
+                planned = plan_file(rel_path, mtime, *read, vector_type)
+            except Exception as e:
+                print(f"Error planning {rel_path}: {e}")
+                if progress:
+                    progress.add("files_done")
+                continue
+
+            job, to_embed, rekeyed = planned
+            if job.pending == 0:
+                # Nothing to write, only stale chunks to drop
+                job.pending = 1
+                write_queue.put(([(job, None, None, None)], False))
+                continue
+            if rekeyed:
+                write_queue.put((rekeyed, False))
+            for item in to_embed:
+                batch.append(item)
+                if len(batch) == BATCH_SIZE:
+                    submit(batch)
+                    batch = []
+    finally:
+        # Also on errors, so the workers exit and the files planned so far are finalized
+        if batch:
+            submit(batch)
+        for _ in embedders:
+            embed_queue.put(None)
+        for thread in embedders:
+            thread.join()
+        write_queue.put(None)
+        writer.join()
+
+def remove_files(rel_paths, progress=None):
+    """
+    Removes files from the index and registry.
+    """
+    for start in range(0, len(rel_paths), REGISTRY_BATCH_SIZE):
+        batch = rel_paths[start:start + REGISTRY_BATCH_SIZE]
+        for rel_path in batch:
             print(f"File deleted on disk, removing from index: {rel_path}")
-            delete_file_chunks(rel_path)
-            redis_client.hdel(REGISTRY_KEY, rel_path)
+        delete_file_chunks(batch)
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.delete(*[chunk_registry_key(rel_path) for rel_path in batch])
+        pipeline.hdel(REGISTRY_KEY, *batch)
+        pipeline.hdel(METADATA_REGISTRY_KEY, *batch)
+        pipeline.execute()
+        if progress:
+            progress.add("files_deleted", len(batch))
+    if rel_paths:
+        metrics.files_deleted.inc(len(rel_paths))
+        bump_index_generation()
 
-def index_notes():
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=100,
+def scan_dir(abs_dir):
+    """
+    Returns the (abs_path, mtime) of the notes directly in abs_dir and its
+    subdirectories. Hidden entries are skipped, as glob does.
+    """
+    notes, subdirs = [], []
+    try:
+        with os.scandir(abs_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith(".md") and entry.is_file():
+                        notes.append((entry.path, entry.stat().st_mtime))
+                except OSError:
+                    # Removed while scanning
+                    continue
+    except OSError as e:
+        print(f"Cannot scan {abs_dir}: {e}")
+    return notes, subdirs
+
+def scan_notes(abs_notes_path):
+    """
+    Returns {rel_path: (abs_path, mtime)} for every note under abs_notes_path.
+    Each directory level is listed by SCAN_WORKERS threads, which hides the
+    latency of network mounts.
+    """
+    notes = {}
+    pending = [abs_notes_path]
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        while pending:
+            results = list(executor.map(scan_dir, pending))
+            pending = []
+            for found, subdirs in results:
+                for abs_path, mtime in found:
+                    notes[os.path.relpath(abs_path, abs_notes_path)] = (abs_path, mtime)
+                pending.extend(subdirs)
+    return notes
+
+def make_splitter():
+    if CHUNKER == "markdown":
+        # Only cuts sections longer than CHUNK_SIZE, headings were split on already
+        return RecursiveCharacterTextSplitter(
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=0,
+            separators=["\n\n", "\n", ". ", " ", ""]
+        )
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
         separators=["\n## ", "\n# ", "\n\n", "\n", " ", ""]
     )
-    
-    # Ensure NOTES_PATH is absolute and exists
-    abs_notes_path = os.path.abspath(NOTES_PATH)
-    all_abs_files = glob.glob(f"{abs_notes_path}/**/*.md", recursive=True)
-    
-    # Convert all found files to relative paths for comparison and registry
-    all_rel_files = [os.path.relpath(f, abs_notes_path) for f in all_abs_files]
-    print(f"Found {len(all_rel_files)} markdown files.")
-    
-    # Cleanup files that are no longer on disk using relative paths
-    cleanup_deleted_files(all_rel_files)
-    
-    for rel_path, abs_path in zip(all_rel_files, all_abs_files):
-        mtime = os.path.getmtime(abs_path)
-        old_mtime = redis_client.hget(REGISTRY_KEY, rel_path)
-        
-        if old_mtime and float(old_mtime) == mtime:
-            continue
-        
-        print(f"Indexing: {rel_path}")
-        # Clear existing index using relative path
-        delete_file_chunks(rel_path)
-        
-        for batch_chunks, start_idx in process_file_in_batches(abs_path, splitter):
-            if not batch_chunks:
+
+def index_notes(progress=None):
+    """
+    Scans NOTES_PATH and brings the index up to date with it. progress, an
+    object with add(counter, amount=1), follows the run (see jobs.IndexJob).
+    """
+    with index_lock:
+        notes = scan_notes(os.path.abspath(NOTES_PATH))
+        print(f"Found {len(notes)} markdown files.")
+        metrics.files_scanned.inc(len(notes))
+
+        # Diff the whole registry in memory instead of one round trip per file
+        registry = redis_client.hgetall(REGISTRY_KEY)
+        remove_files([rel_path for rel_path in registry if rel_path not in notes], progress)
+
+        changed_files = [
+            (rel_path, abs_path, mtime)
+            for rel_path, (abs_path, mtime) in notes.items()
+            if not registry.get(rel_path) or float(registry[rel_path]) != mtime
+        ]
+        if changed_files:
+            print(f"{len(changed_files)} files changed.")
+            metrics.files_changed.inc(len(changed_files))
+            if progress:
+                progress.add("files_total", len(changed_files))
+            run_pipeline(changed_files, progress)
+
+def index_paths(rel_paths, progress=None):
+    """
+    Brings only the given notes up to date, for callers that already know
+    which files were touched. Notes missing on disk are removed.
+    """
+    if not rel_paths:
+        return
+    with index_lock:
+        abs_notes_path = os.path.abspath(NOTES_PATH)
+        changed_files, deleted = [], []
+        for rel_path, old_mtime in zip(rel_paths, redis_client.hmget(REGISTRY_KEY, rel_paths)):
+            abs_path = os.path.join(abs_notes_path, rel_path)
+            if not os.path.isfile(abs_path):
+                if old_mtime is not None:
+                    deleted.append(rel_path)
                 continue
-                
-            # Batch embedding
-            response = call_embedding(batch_chunks)
-            embeddings = [np.array(emb.embedding, dtype=np.float32).tobytes() for emb in response.data]
-            
-            # Batch storage using relative path
-            pipeline = redis_client.pipeline()
-            for i, (chunk, vector) in enumerate(zip(batch_chunks, embeddings)):
-                # doc_id also uses relative path to be consistent
-                doc_id = f"prag:default:{rel_path}:{start_idx + i}"
-                pipeline.hset(doc_id, mapping={
-                    "content": chunk,
-                    "path": rel_path,
-                    "vector": vector
-                })
+            mtime = os.path.getmtime(abs_path)
+            if old_mtime and float(old_mtime) == mtime:
+                continue
+            changed_files.append((rel_path, abs_path, mtime))
+
+        remove_files(deleted, progress)
+        if changed_files:
+            print(f"{len(changed_files)} files changed.")
+            metrics.files_changed.inc(len(changed_files))
+            if progress:
+                progress.add("files_total", len(changed_files))
+            run_pipeline(changed_files, progress)
+
+def scan_chunk_keys(batch_size):
+    """
+    Yields lists of up to batch_size chunk keys.
+    """
+    keys = []
+    for key in redis_client.scan_iter(match="prag:default:*", count=batch_size, _type="HASH"):
+        keys.append(key)
+        if len(keys) == batch_size:
+            yield keys
+            keys = []
+    if keys:
+        yield keys
+
+def convert_vectors(keys, old_type, new_type):
+    """
+    Writes new_type vectors for the chunks that only have old_type ones.
+    Vectors found in the embedding cache are converted from their original
+    float32 values instead of the stored, possibly quantized, ones.
+    Returns the number of converted vectors.
+    """
+    old_field, new_field = vector_field(old_type), vector_field(new_type)
+    pipeline = redis_binary_client.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hmget(key, ["content", "heading", old_field, new_field])
+    rows = [
+        (key, embedding_text((heading or b"").decode("utf-8"), content.decode("utf-8")), vector)
+        for key, (content, heading, vector, new_vector) in zip(keys, pipeline.execute())
+        if vector is not None and new_vector is None
+    ]
+    if not rows:
+        return 0
+
+    # Cached under the text that was embedded, heading included
+    originals = redis_binary_client.mget([embedding_cache_key(text) for _, text, _ in rows])
+    vectors = np.array([
+        np.frombuffer(original, dtype=np.float32) if original else decode_vectors(vector, old_type)
+        for (_, _, vector), original in zip(rows, originals)
+    ])
+    pipeline = redis_binary_client.pipeline(transaction=False)
+    for (key, _, _), vector in zip(rows, encode_vectors(vectors, new_type)):
+        pipeline.hset(key, new_field, vector.tobytes())
+    pipeline.execute()
+    return len(rows)
+
+def wait_until_indexed(name, poll_interval=2):
+    """
+    Blocks until RediSearch finished indexing the existing chunks into name.
+    """
+    while True:
+        info = redis_client.ft(name).info()
+        percent = float(info.get("percent_indexed", 1))
+        if int(float(info.get("indexing", 0))) == 0 and percent >= 1:
+            return info
+        print(f"Building {name}: {percent * 100:.1f}%")
+        time.sleep(poll_interval)
+
+def rebuild_index(dim=EMBEDDING_DIM, batch_size=500):
+    """
+    Builds a new index with the current VECTOR_TYPE and HNSW settings next to
+    the live one, then points the INDEX_NAME alias at it and drops the old
+    index, so searches keep being served during the rebuild. When the vector
+    type changes, converted vectors are written to the new type's field
+    before the build and the old field is removed after the swap.
+    Holds the index lock throughout, an indexing run would keep writing the
+    vector type it started with.
+    """
+    if get_vector_store().local:
+        print("VECTOR_STORE=local searches exactly and has no index to rebuild.")
+        return
+    print("Taking the index lock, waiting for any running indexing job...")
+    with hold_index_lock():
+        swap_index(dim, batch_size)
+
+def swap_index(dim, batch_size):
+    """
+    The steps of rebuild_index, run while holding the index lock.
+    """
+    try:
+        index_attributes()
+    except ResponseError as e:
+        if not is_unknown_index(e):
+            raise
+        create_index(dim)
+        return
+
+    old_type = get_index_vector_type()
+    old_index = get_physical_index()
+    if old_type != VECTOR_TYPE:
+        print(f"Converting {old_type} vectors to {VECTOR_TYPE}...")
+        converted = 0
+        for keys in scan_chunk_keys(batch_size):
+            converted += convert_vectors(keys, old_type, VECTOR_TYPE)
+        print(f"Converted {converted} vectors.")
+
+    new_index = create_physical_index(VECTOR_TYPE, dim)
+    print(f"Building {new_index} (M={HNSW_M}, EF_CONSTRUCTION={HNSW_EF_CONSTRUCTION}, EF_RUNTIME={HNSW_EF_RUNTIME})...")
+    info = wait_until_indexed(new_index)
+
+    if old_index == INDEX_NAME:
+        # The live index predates the alias and owns its name, so this first swap is not atomic
+        redis_client.ft(INDEX_NAME).dropindex(delete_documents=False)
+        redis_client.ft(new_index).aliasadd(INDEX_NAME)
+    else:
+        redis_client.ft(new_index).aliasupdate(INDEX_NAME)
+        redis_client.ft(old_index).dropindex(delete_documents=False)
+    redis_client.mset({INDEX_PHYSICAL_KEY: new_index, INDEX_VECTOR_TYPE_KEY: VECTOR_TYPE})
+
+    if old_type != VECTOR_TYPE:
+        # Chunks written during the build still carry the old type only
+        old_field = vector_field(old_type)
+        for keys in scan_chunk_keys(batch_size):
+            convert_vectors(keys, old_type, VECTOR_TYPE)
+            pipeline = redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.hdel(key, old_field)
             pipeline.execute()
-            
-        # Update registry with relative path
-        redis_client.hset(REGISTRY_KEY, rel_path, mtime)
-        print(f"Finished: {rel_path}")
+    bump_index_generation()
+    print(f"{INDEX_NAME} now points at {new_index} ({info.get('num_docs')} docs), dropped {old_index}.")
 
 if __name__ == "__main__":
     start_time = time.time()
-    create_index()
-    index_notes()
-    print(f"Indexing completed in {time.time() - start_time:.2f} seconds.")
+    if sys.argv[1:] in (["rebuild"], ["migrate"]):
+        rebuild_index()
+        print(f"Rebuild completed in {time.time() - start_time:.2f} seconds.")
+    else:
+        create_index()
+        index_notes()
+        print(f"Indexing completed in {time.time() - start_time:.2f} seconds.")
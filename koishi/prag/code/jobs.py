@@ -0,0 +1,153 @@
+import time
+import uuid
+import socket
+import threading
+from common import redis_client, INDEX_JOB_KEY, hold_index_lock
+from indexer import index_notes, index_paths
+
+# Seconds between attempts to take the index lock while another replica holds it
+LOCK_POLL_INTERVAL = 5
+# Progress counters are written to Redis at most this often
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+COUNTERS = ("files_total", "files_done", "files_deleted", "chunks_embedded")
+
+class IndexJob:
+    """
+    One indexing run, rel_paths is None for a full scan of NOTES_PATH.
+    Triggers arriving before it starts are merged into it.
+    """
+    def __init__(self, trigger, rel_paths=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.triggers = {trigger}
+        self.rel_paths = None if rel_paths is None else set(rel_paths)
+        self.queued_at = time.time()
+        self.state = "queued"
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.last_flush = 0
+        self.lock = threading.Lock()
+
+    def merge(self, trigger, rel_paths=None):
+        self.triggers.add(trigger)
+        if rel_paths is None:
+            self.rel_paths = None
+        elif self.rel_paths is not None:
+            self.rel_paths.update(rel_paths)
+
+    def scope(self):
+        return "full" if self.rel_paths is None else f"{len(self.rel_paths)} files"
+
+    def summary(self):
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "trigger": ",".join(sorted(self.triggers)),
+            "scope": self.scope(),
+            "queued_at": self.queued_at
+        }
+
+    def add(self, counter, amount=1):
+        """
+        Progress callback of index_notes and index_paths.
+        """
+        with self.lock:
+            self.counters[counter] += amount
+            if time.monotonic() - self.last_flush < PROGRESS_FLUSH_INTERVAL:
+                return
+            self.last_flush = time.monotonic()
+            counters = dict(self.counters)
+        try:
+            redis_client.hset(INDEX_JOB_KEY, mapping=counters)
+        except Exception as e:
+            print(f"Error storing progress of indexing job {self.id}: {e}")
+
+_condition = threading.Condition()
+_queued = None  # IndexJob waiting for the running one
+_running = None
+_worker = None
+
+def request_index(trigger, rel_paths=None):
+    """
+    Queues an indexing run of rel_paths, or of every note when None, and
+    returns the job id. Requests made while a job is queued are merged into
+    it, so any number of triggers during a run cost a single run after it.
+    """
+    global _queued, _worker
+    with _condition:
+        if _queued is None:
+            _queued = IndexJob(trigger, rel_paths)
+        else:
+            _queued.merge(trigger, rel_paths)
+        if _worker is None:
+            _worker = threading.Thread(target=run_jobs, name="index-jobs", daemon=True)
+            _worker.start()
+        _condition.notify()
+        return _queued.id
+
+def run_jobs():
+    global _queued, _running
+    while True:
+        with _condition:
+            while _queued is None:
+                _condition.wait()
+            _running, _queued = _queued, None
+        try:
+            run_job(_running)
+        except Exception as e:
+            print(f"Indexing job {_running.id} failed: {e!r}")
+        finally:
+            with _condition:
+                _running = None
+
+def run_job(job):
+    """
+    Runs job once this replica holds the index lock in Redis, so indexing
+    runs of all replicas, the scheduler and the watcher never overlap.
+    """
+    job.state = "waiting"
+    with hold_index_lock(LOCK_POLL_INTERVAL):
+        job.state = "running"
+        error = ""
+        try:
+            pipeline = redis_client.pipeline()
+            pipeline.delete(INDEX_JOB_KEY)
+            pipeline.hset(INDEX_JOB_KEY, mapping={
+                **job.summary(),
+                "host": socket.gethostname(),
+                "started_at": time.time(),
+                **job.counters
+            })
+            pipeline.execute()
+            if job.rel_paths is None:
+                index_notes(progress=job)
+            else:
+                index_paths(sorted(job.rel_paths), progress=job)
+            job.state = "finished"
+        except Exception as e:
+            print(f"Indexing job {job.id} failed: {e!r}")
+            job.state, error = "failed", repr(e)
+        finally:
+            redis_client.hset(INDEX_JOB_KEY, mapping={
+                "state": job.state, "error": error, "finished_at": time.time(), **job.counters
+            })
+
+def index_status():
+    """
+    State and progress of the running or last job of any replica, with an
+    ETA from the rate of files done so far, and the jobs of this replica
+    queued or waiting for another replica to release the index lock.
+    """
+    current = redis_client.hgetall(INDEX_JOB_KEY) or None
+    eta = None
+    if current:
+        for field in COUNTERS:
+            current[field] = int(current.get(field, 0))
+        for field in ("queued_at", "started_at", "finished_at"):
+            if field in current:
+                current[field] = float(current[field])
+        done, total = current["files_done"], current["files_total"]
+        if current["state"] == "running" and done:
+            eta = round((time.time() - current["started_at"]) / done * max(total - done, 0), 1)
+    with _condition:
+        pending = [job.summary() for job in (_running, _queued) if job and job.state in ("queued", "waiting")]
+    return {"current": current, "eta_seconds": eta, "pending": pending}
@@ -0,0 +1,107 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Prometheus text exposition without the client library, metrics live in this process only
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+
+def format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+class Counter:
+    """
+    A monotonically increasing value per label set.
+    """
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(key)} {format_value(value)}")
+        return lines
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets per label set.
+    """
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = (*buckets, float("inf"))
+        self.values = {}  # labels -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key, [('le', format_value(bound))])} {bucket_count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {format_value(total)}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+def render_gauges(gauges):
+    """
+    Renders values read at scrape time, gauges maps a metric name to
+    (help text, value).
+    """
+    lines = []
+    for name, (help_text, value) in gauges.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {format_value(value)}"]
+    return lines
+
+def render(gauges=None):
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    lines += render_gauges(gauges or {})
+    return "\n".join(lines) + "\n"
+
+files_scanned = Counter("prag_files_scanned_total", "Notes found by full scans.")
+files_changed = Counter("prag_files_changed_total", "Notes queued for indexing because they are new or modified.")
+files_deleted = Counter("prag_files_deleted_total", "Notes removed from the index because they left the disk.")
+chunks_embedded = Counter("prag_chunks_embedded_total", "Chunks sent through the embedding stage.")
+embedding_errors = Counter("prag_embedding_errors_total", "Embedding batches that failed while indexing.")
+embedding_batch_seconds = Histogram("prag_embedding_batch_seconds", "Latency of embedding one indexing batch.")
+redis_pipeline_seconds = Histogram("prag_redis_pipeline_seconds", "Latency of Redis write pipelines while indexing.")
+query_seconds = Histogram("prag_query_seconds", "Query latency by stage (embed, search, total).")
+query_cache = Counter("prag_query_cache_total", "Result cache lookups of queries by result (hit, miss).")
@@ -1,39 +1,507 @@
+import re
 import sys
 import json
+import time
+import asyncio
 import numpy as np
+from redis.commands.search.document import Document
 from redis.commands.search.query import Query
-from common import redis_client, INDEX_NAME, call_embedding
+from redis.commands.search.result import Result
+import metrics
+from common import (
+    redis_client, async_redis_client, redis_binary_client, async_redis_binary_client,
+    INDEX_NAME, INDEX_GENERATION_KEY, INDEX_VECTOR_TYPE_KEY,
+    QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_EMBEDDING_TIMEOUT, MMR_LAMBDA, CHUNKER, CHUNK_OVERLAP, TTLCache,
+    get_embeddings, async_get_embeddings, get_vector_store, escape_tag, encode_vectors, decode_vectors,
+    EMBEDDING_CACHE_SIZE, embedding_cache_key, embedding_text
+)
 
-def search_notes(query_text, top_k=5):
+RRF_K = 60  # Reciprocal rank fusion constant, damps the weight of top ranks
+MAX_QUERY_TERMS = 32
+HYBRID_CANDIDATES_FACTOR = 2  # Each side of a hybrid search fetches top_k * factor candidates
+INT8_RERANK_FACTOR = 4  # INT8 indexes fetch top_k * factor candidates and re-rank them in float32
+MMR_CANDIDATES_FACTOR = 4  # MMR picks top_k out of top_k * factor candidates
+MAX_EXPAND = 5  # Max neighbor chunks added on each side of a hit
+MIN_MERGE_OVERLAP = 8  # Shorter matches between neighbor chunks are treated as coincidence
+
+# Query vectors do not depend on the index, results are keyed by the index generation
+_query_vector_cache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+_result_cache = TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+def build_filter(path_prefix=None, folder=None, tags=None):
     """
-    Retrieves relevant notes from Redis and returns them as a list of dicts.
+    Builds a pre-filter expression from the optional scopes: notes whose path
+    starts with path_prefix, notes in the top-level folder, notes having any
+    of the frontmatter tags. Returns "*" when nothing is filtered.
     """
-    response = call_embedding(query_text)
-    query_vector = np.array(response.data[0].embedding, dtype=np.float32).tobytes()
-    
+    clauses = []
+    if path_prefix:
+        clauses.append(f"@path:{{{escape_tag(path_prefix)}*}}")
+    if folder:
+        clauses.append(f"@folder:{{{escape_tag(folder)}}}")
+    if tags:
+        clauses.append(f"@tags:{{{'|'.join(escape_tag(tag) for tag in tags)}}}")
+    return " ".join(clauses) if clauses else "*"
+
+def build_knn_query(top_k, filter_expr="*", ef_runtime=None):
     # Redis KNN using COSINE distance returns distance (0-1).
     # Similarity = 1 - distance
-    q = (
-        Query(f"(*)=>[KNN {top_k} @vector $vec as dist]")
+    return (
+        Query(f"({filter_expr})=>[KNN {top_k} @vector $vec{knn_ef_clause(ef_runtime)} as dist]")
         .sort_by("dist")
-        .return_fields("content", "path", "dist")
+        .return_fields("content", "path", "heading", "dist")
+        .paging(0, top_k)
         .dialect(2)
     )
-    
-    results = redis_client.ft(INDEX_NAME).search(q, query_params={"vec": query_vector})
-    
-    docs = []
-    for doc in results.docs:
-        # Convert distance to similarity score
-        similarity = 1 - float(doc.dist)
-        docs.append({
+
+def knn_ef_clause(ef_runtime):
+    # Overrides the index's HNSW EF_RUNTIME for one query, a larger value trades latency for recall
+    return f" EF_RUNTIME {int(ef_runtime)}" if ef_runtime else ""
+
+def build_text_query(query_text, top_k, filter_expr="*"):
+    """
+    Full-text query matching any of the query terms, ranked by BM25.
+    Returns None if the query has no searchable terms.
+    """
+    terms = list(dict.fromkeys(re.findall(r"\w+", query_text.lower())))[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    query_string = f"@content:({'|'.join(terms)})"
+    if filter_expr != "*":
+        query_string = f"{query_string} {filter_expr}"
+    return (
+        Query(query_string)
+        .scorer("BM25")
+        .with_scores()
+        .return_fields("content", "path", "heading")
+        .paging(0, top_k)
+        .dialect(2)
+    )
+
+def search_args(query, query_params=None):
+    """
+    Raw FT.SEARCH arguments, for queueing searches on a pipeline.
+    """
+    args = [INDEX_NAME, *query.get_args()]
+    if query_params:
+        args += ["PARAMS", len(query_params) * 2]
+        for name, value in query_params.items():
+            args += [name, value]
+    return args
+
+def vector_hits(results):
+    # Convert distance to similarity score
+    return [(doc.id, doc, 1 - float(doc.dist)) for doc in results.docs]
+
+def text_hits(results):
+    return [(doc.id, doc, float(doc.score)) for doc in results.docs]
+
+def fuse_hits(vector, text, top_k):
+    """
+    Merges two ranked hit lists with reciprocal rank fusion.
+    """
+    scores = {}
+    docs = {}
+    for hits in (vector, text):
+        for rank, (doc_id, doc, _) in enumerate(hits, start=1):
+            scores[doc_id] = scores.get(doc_id, 0) + 1 / (RRF_K + rank)
+            docs.setdefault(doc_id, doc)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [(doc_id, docs[doc_id], scores[doc_id]) for doc_id in ranked]
+
+def format_hits(hits):
+    return [
+        {
             "content": doc.content,
-            "score": round(similarity, 4),
-            "source": doc.path
-        })
-    
+            "score": round(score, 4),
+            "source": doc.path,
+            # Chunks indexed without heading metadata do not return the field
+            "heading": getattr(doc, "heading", None) or ""
+        }
+        for _, doc, score in hits
+    ]
+
+def neighbor_keys(hits, expand):
+    """
+    Returns, per hit, the keys of its chunk and of up to expand chunks of
+    the same note on each side, in order.
+    """
+    ranges = []
+    for doc_id, _, _ in hits:
+        prefix, idx = doc_id.rsplit(":", 1)
+        idx = int(idx)
+        ranges.append([f"{prefix}:{i}" for i in range(max(0, idx - expand), idx + expand + 1)])
+    return ranges
+
+def merge_chunks(chunks):
+    """
+    Joins consecutive chunks, dropping the text each chunk repeats from the
+    end of the previous one. Markdown chunks do not overlap, so text they
+    seem to repeat (table rules, bullets, fences) is kept.
+    """
+    max_overlap = 0 if CHUNKER == "markdown" else CHUNK_OVERLAP
+    text = chunks[0]
+    for chunk in chunks[1:]:
+        longest = min(len(text), len(chunk), max_overlap)
+        overlap = next((size for size in range(longest, MIN_MERGE_OVERLAP - 1, -1) if text.endswith(chunk[:size])), 0)
+        text += chunk[overlap:] if overlap else "\n" + chunk
+    return text
+
+def expand_docs(docs, ranges, contents):
+    """
+    Replaces the content of each result by its merged neighborhood, contents
+    holds the content of every key of ranges, None for missing chunks.
+    """
+    contents = iter(contents)
+    for doc, keys in zip(docs, ranges):
+        chunks = [content for _, content in zip(keys, contents) if content is not None]
+        if chunks:
+            doc["content"] = merge_chunks(chunks)
+    return docs
+
+def expand_results(docs, hits, expand):
+    if not expand or not hits:
+        return docs
+    ranges = neighbor_keys(hits, expand)
+    pipeline = redis_client.pipeline(transaction=False)
+    for key in (key for keys in ranges for key in keys):
+        pipeline.hget(key, "content")
+    return expand_docs(docs, ranges, pipeline.execute())
+
+async def async_expand_results(docs, hits, expand):
+    if not expand or not hits:
+        return docs
+    ranges = neighbor_keys(hits, expand)
+    pipeline = async_redis_client.pipeline(transaction=False)
+    for key in (key for keys in ranges for key in keys):
+        pipeline.hget(key, "content")
+    return expand_docs(docs, ranges, await pipeline.execute())
+
+def query_vector(query_text):
+    vector = _query_vector_cache.get(query_text)
+    if vector is None:
+        vector = get_embeddings(query_text)[0]
+        _query_vector_cache.set(query_text, vector)
+    return vector
+
+async def async_query_vector(query_text):
+    vector = _query_vector_cache.get(query_text)
+    if vector is None:
+        embeddings = await asyncio.wait_for(async_get_embeddings(query_text), QUERY_EMBEDDING_TIMEOUT)
+        vector = embeddings[0]
+        _query_vector_cache.set(query_text, vector)
+    return vector
+
+def knn_params(vector, vector_type):
+    return {"vec": encode_vectors(vector[np.newaxis], vector_type)[0].tobytes()}
+
+def knn_candidates(top_k, vector_type):
+    return top_k * INT8_RERANK_FACTOR if vector_type == "INT8" else top_k
+
+def stored_matrix(stored, vector_type):
+    """
+    Returns the stored vectors as rows of an L2-normalized float32 matrix.
+    """
+    matrix = decode_vectors(b"".join(stored), vector_type).reshape(len(stored), -1)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return matrix
+
+def original_keys(hits):
+    # Chunks are cached under the text they were embedded as
+    return [
+        embedding_cache_key(embedding_text(getattr(doc, "heading", None) or "", doc.content))
+        for _, doc, _ in hits
+    ]
+
+def merge_originals(hits, originals, stored, vector_type):
+    """
+    Returns the float32 vector of each hit, the original from the embedding
+    cache when found, else its dequantized stored vector. stored holds the
+    stored vectors of the hits missing from the cache, None when deleted.
+    """
+    stored = iter(stored)
+    vectors = []
+    for original in originals:
+        if original is None:
+            original = next(stored)
+            vectors.append(None if original is None else decode_vectors(original, vector_type))
+        else:
+            vectors.append(np.frombuffer(original, dtype=np.float32))
+    return vectors
+
+def float_vectors(hits, vector_type):
+    originals = redis_binary_client.mget(original_keys(hits)) if EMBEDDING_CACHE_SIZE > 0 else [None] * len(hits)
+    missing = [hit for hit, original in zip(hits, originals) if original is None]
+    stored = stored_vectors(missing, vector_type) if missing else []
+    return merge_originals(hits, originals, stored, vector_type)
+
+async def async_float_vectors(hits, vector_type):
+    originals = await async_redis_binary_client.mget(original_keys(hits)) if EMBEDDING_CACHE_SIZE > 0 else [None] * len(hits)
+    missing = [hit for hit, original in zip(hits, originals) if original is None]
+    stored = await async_stored_vectors(missing, vector_type) if missing else []
+    return merge_originals(hits, originals, stored, vector_type)
+
+def rerank_hits(hits, vector, vectors, top_k):
+    """
+    Re-scores KNN candidates by the cosine similarity between the float32
+    query vector and the float32 vectors of the candidates (see float_vectors),
+    which corrects the quantization error on both sides where the originals
+    are still cached.
+    """
+    candidates = [(hit, data) for hit, data in zip(hits, vectors) if data is not None]
+    if not candidates:
+        return hits[:top_k]
+    matrix = np.array([data for _, data in candidates], dtype=np.float32)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    scores = matrix @ (vector / max(np.linalg.norm(vector), 1e-12))
+    order = np.argsort(-scores)[:top_k]
+    return [(candidates[i][0][0], candidates[i][0][1], float(scores[i])) for i in order]
+
+def mmr_hits(hits, vector, stored, vector_type, top_k):
+    """
+    Picks top_k hits by maximal marginal relevance. Each pick maximizes
+    MMR_LAMBDA * similarity to the query - (1 - MMR_LAMBDA) * the highest
+    similarity to an already picked hit, so overlapping chunks of the same
+    passage do not fill the results. Hits keep their original score.
+    """
+    candidates = [hit for hit, data in zip(hits, stored) if data is not None]
+    if not candidates:
+        return hits[:top_k]
+    matrix = stored_matrix([data for data in stored if data is not None], vector_type)
+    relevance = matrix @ (vector / max(np.linalg.norm(vector), 1e-12))
+    similarity = matrix @ matrix.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    for _ in range(min(top_k, len(candidates)) - 1):
+        scores = MMR_LAMBDA * relevance - (1 - MMR_LAMBDA) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return [candidates[i] for i in selected]
+
+def stored_vectors(hits, vector_type):
+    return get_vector_store().get([doc_id for doc_id, _, _ in hits], vector_type)
+
+async def async_stored_vectors(hits, vector_type):
+    return await get_vector_store().async_get([doc_id for doc_id, _, _ in hits], vector_type)
+
+def index_vector_type(stored):
+    # The local store keeps float32 vectors whatever the Redis index was built with
+    return "FLOAT32" if get_vector_store().local else stored or "FLOAT32"
+
+def stored_hits(matches, replies):
+    """
+    Builds hits from the (key, score) matches of the local store and the
+    (content, path, heading) of each chunk, skipping chunks deleted meanwhile.
+    """
+    return [
+        (key, Document(key, content=content, path=path, heading=heading), score)
+        for (key, score), (content, path, heading) in zip(matches, replies)
+        if content is not None
+    ]
+
+def local_hits(vector, top_k, path_prefix=None, folder=None, tags=None):
+    matches = get_vector_store().search(vector, top_k, path_prefix, folder, tags)
+    pipeline = redis_client.pipeline(transaction=False)
+    for key, _ in matches:
+        pipeline.hmget(key, "content", "path", "heading")
+    return stored_hits(matches, pipeline.execute())
+
+async def async_local_hits(vector, top_k, path_prefix=None, folder=None, tags=None):
+    # The matrix product releases the GIL, a worker thread keeps the event loop free
+    matches = await asyncio.to_thread(get_vector_store().search, vector, top_k, path_prefix, folder, tags)
+    pipeline = async_redis_client.pipeline(transaction=False)
+    for key, _ in matches:
+        pipeline.hmget(key, "content", "path", "heading")
+    return stored_hits(matches, await pipeline.execute())
+
+def vector_search(vector, top_k, filter_expr, vector_type, ef_runtime=None):
+    query = build_knn_query(knn_candidates(top_k, vector_type), filter_expr, ef_runtime)
+    hits = vector_hits(redis_client.ft(INDEX_NAME).search(query, query_params=knn_params(vector, vector_type)))
+    if vector_type != "INT8":
+        return hits
+    return rerank_hits(hits, vector, float_vectors(hits, vector_type), top_k)
+
+async def async_rerank(hits, vector, vector_type, top_k):
+    """
+    Re-ranks the candidates of an INT8 index, other hits are returned as is.
+    """
+    if vector_type != "INT8":
+        return hits
+    return rerank_hits(hits, vector, await async_float_vectors(hits, vector_type), top_k)
+
+def search_notes(query_text, top_k=5, mode="vector", path_prefix=None, folder=None, tags=None,
+                 ef_runtime=None, rerank="none", expand=0):
+    """
+    Retrieves relevant notes from Redis and returns them as a list of dicts.
+    mode is "vector" (KNN, score is cosine similarity), "lexical" (BM25 over
+    the content, score is the BM25 score) or "hybrid" (both fused by
+    reciprocal rank, score is the fused score). Vector and hybrid searches
+    fall back to lexical when the query cannot be embedded. The local
+    vector store has no full-text index, there hybrid searches are vector
+    searches and lexical ones find nothing.
+    path_prefix, folder and tags scope the search, see build_filter.
+    ef_runtime overrides the HNSW_EF_RUNTIME the index was built with.
+    rerank="mmr" diversifies vector and hybrid results, see mmr_hits.
+    expand=n replaces the content of each result by the result chunk merged
+    with up to n neighbor chunks on each side.
+    """
+    filter_expr = build_filter(path_prefix, folder, tags)
+    generation, vector_type = redis_client.mget(INDEX_GENERATION_KEY, INDEX_VECTOR_TYPE_KEY)
+    vector_type = index_vector_type(vector_type)
+    cache_key = (query_text, top_k, mode, filter_expr, ef_runtime, rerank, expand, generation)
+    docs = _result_cache.get(cache_key)
+    metrics.query_cache.inc(result="miss" if docs is None else "hit")
+    if docs is not None:
+        return docs
+    start = time.perf_counter()
+
+    vector = None
+    if mode != "lexical":
+        try:
+            with metrics.query_seconds.time(stage="embed"):
+                vector = query_vector(query_text)
+        except Exception as e:
+            print(f"Embedding failed, falling back to lexical search: {e!r}")
+
+    search_start = time.perf_counter()
+    search = redis_client.ft(INDEX_NAME)
+    local = get_vector_store().local
+    fetch_k = top_k * MMR_CANDIDATES_FACTOR if rerank == "mmr" else top_k
+    if vector is None:
+        text_query = None if local else build_text_query(query_text, top_k, filter_expr)
+        hits = text_hits(search.search(text_query)) if text_query else []
+    elif local:
+        hits = local_hits(vector, fetch_k, path_prefix, folder, tags)
+    elif mode == "hybrid":
+        candidates = fetch_k * HYBRID_CANDIDATES_FACTOR
+        hits = vector_search(vector, candidates, filter_expr, vector_type, ef_runtime)
+        text_query = build_text_query(query_text, candidates, filter_expr)
+        hits = fuse_hits(hits, text_hits(search.search(text_query)) if text_query else [], fetch_k)
+    else:
+        hits = vector_search(vector, fetch_k, filter_expr, vector_type, ef_runtime)
+    if vector is not None and rerank == "mmr":
+        hits = mmr_hits(hits, vector, stored_vectors(hits, vector_type), vector_type, top_k)
+
+    docs = expand_results(format_hits(hits), hits, expand)
+    metrics.query_seconds.observe(time.perf_counter() - search_start, stage="search")
+    metrics.query_seconds.observe(time.perf_counter() - start, stage="total")
+    if vector is not None or mode == "lexical":
+        _result_cache.set(cache_key, docs)
     return docs
 
+async def async_search_notes(query_text, top_k=5, mode="vector", path_prefix=None, folder=None, tags=None,
+                             ef_runtime=None, rerank="none", expand=0):
+    """
+    Same as search_notes, without blocking the event loop on the embedding
+    call or the search round trip. Hybrid mode pipelines both searches, and
+    an embedding call slower than QUERY_EMBEDDING_TIMEOUT also falls back to
+    lexical search.
+    """
+    filter_expr = build_filter(path_prefix, folder, tags)
+    generation, vector_type = await async_redis_client.mget(INDEX_GENERATION_KEY, INDEX_VECTOR_TYPE_KEY)
+    vector_type = index_vector_type(vector_type)
+    cache_key = (query_text, top_k, mode, filter_expr, ef_runtime, rerank, expand, generation)
+    docs = _result_cache.get(cache_key)
+    metrics.query_cache.inc(result="miss" if docs is None else "hit")
+    if docs is not None:
+        return docs
+    start = time.perf_counter()
+
+    vector = None
+    if mode != "lexical":
+        try:
+            with metrics.query_seconds.time(stage="embed"):
+                vector = await async_query_vector(query_text)
+        except Exception as e:
+            print(f"Embedding failed, falling back to lexical search: {e!r}")
+
+    search_start = time.perf_counter()
+    local = get_vector_store().local
+    fetch_k = top_k * MMR_CANDIDATES_FACTOR if rerank == "mmr" else top_k
+    if vector is None:
+        text_query = None if local else build_text_query(query_text, top_k, filter_expr)
+        hits = text_hits(await async_redis_client.ft(INDEX_NAME).search(text_query)) if text_query else []
+    elif local:
+        hits = await async_local_hits(vector, fetch_k, path_prefix, folder, tags)
+    elif mode == "hybrid":
+        candidates = fetch_k * HYBRID_CANDIDATES_FACTOR
+        knn_query = build_knn_query(knn_candidates(candidates, vector_type), filter_expr, ef_runtime)
+        text_query = build_text_query(query_text, candidates, filter_expr)
+        pipeline = async_redis_client.pipeline(transaction=False)
+        pipeline.execute_command("FT.SEARCH", *search_args(knn_query, knn_params(vector, vector_type)))
+        if text_query:
+            pipeline.execute_command("FT.SEARCH", *search_args(text_query))
+        replies = await pipeline.execute()
+        vector_side = await async_rerank(vector_hits(Result(replies[0], True)), vector, vector_type, candidates)
+        text_side = text_hits(Result(replies[1], True, with_scores=True)) if text_query else []
+        hits = fuse_hits(vector_side, text_side, fetch_k)
+    else:
+        knn_query = build_knn_query(knn_candidates(fetch_k, vector_type), filter_expr, ef_runtime)
+        results = await async_redis_client.ft(INDEX_NAME).search(knn_query, query_params=knn_params(vector, vector_type))
+        hits = await async_rerank(vector_hits(results), vector, vector_type, fetch_k)
+    if vector is not None and rerank == "mmr":
+        hits = mmr_hits(hits, vector, await async_stored_vectors(hits, vector_type), vector_type, top_k)
+
+    docs = await async_expand_results(format_hits(hits), hits, expand)
+    metrics.query_seconds.observe(time.perf_counter() - search_start, stage="search")
+    metrics.query_seconds.observe(time.perf_counter() - start, stage="total")
+    if vector is not None or mode == "lexical":
+        _result_cache.set(cache_key, docs)
+    return docs
+
+async def async_search_notes_batch(queries, top_k=5, path_prefix=None, folder=None, tags=None,
+                                   ef_runtime=None, rerank="none", expand=0):
+    """
+    Answers several queries with one embedding call for all uncached query
+    vectors and one pipelined round trip for the KNN searches.
+    Returns one result list per query, in order.
+    """
+    filter_expr = build_filter(path_prefix, folder, tags)
+    generation, vector_type = await async_redis_client.mget(INDEX_GENERATION_KEY, INDEX_VECTOR_TYPE_KEY)
+    vector_type = index_vector_type(vector_type)
+    options = (top_k, "vector", filter_expr, ef_runtime, rerank, expand, generation)
+    cached = [_result_cache.get((query_text, *options)) for query_text in queries]
+    pending = list(dict.fromkeys(query_text for query_text, docs in zip(queries, cached) if docs is None))
+    metrics.query_cache.inc(len(queries) - len(pending), result="hit")
+    metrics.query_cache.inc(len(pending), result="miss")
+    if not pending:
+        return cached
+    start = time.perf_counter()
+
+    vectors = {query_text: _query_vector_cache.get(query_text) for query_text in pending}
+    to_embed = [query_text for query_text, vector in vectors.items() if vector is None]
+    if to_embed:
+        with metrics.query_seconds.time(stage="embed"):
+            embeddings = await async_get_embeddings(to_embed)
+        for query_text, vector in zip(to_embed, embeddings):
+            vectors[query_text] = vector
+            _query_vector_cache.set(query_text, vector)
+
+    search_start = time.perf_counter()
+    fetch_k = top_k * MMR_CANDIDATES_FACTOR if rerank == "mmr" else top_k
+    if get_vector_store().local:
+        searched = [await async_local_hits(vectors[query_text], fetch_k, path_prefix, folder, tags) for query_text in pending]
+    else:
+        query = build_knn_query(knn_candidates(fetch_k, vector_type), filter_expr, ef_runtime)
+        pipeline = async_redis_client.pipeline(transaction=False)
+        for query_text in pending:
+            pipeline.execute_command("FT.SEARCH", *search_args(query, knn_params(vectors[query_text], vector_type)))
+        searched = [vector_hits(Result(reply, True)) for reply in await pipeline.execute()]
+
+    fresh = {}
+    for query_text, hits in zip(pending, searched):
+        hits = await async_rerank(hits, vectors[query_text], vector_type, fetch_k)
+        if rerank == "mmr":
+            hits = mmr_hits(hits, vectors[query_text], await async_stored_vectors(hits, vector_type), vector_type, top_k)
+        fresh[query_text] = await async_expand_results(format_hits(hits), hits, expand)
+        _result_cache.set((query_text, *options), fresh[query_text])
+    metrics.query_seconds.observe(time.perf_counter() - search_start, stage="search")
+    metrics.query_seconds.observe(time.perf_counter() - start, stage="total")
+    return [fresh[query_text] if docs is None else docs for query_text, docs in zip(queries, cached)]
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         query = " ".join(sys.argv[1:])
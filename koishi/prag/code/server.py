@@ -1,63 +1,146 @@
 import os
 import asyncio
+from typing import Literal
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Response
+from pydantic import BaseModel, Field
 from apscheduler.schedulers.background import BackgroundScheduler
-from indexer import create_index, index_notes
-from search import search_notes
-from common import redis_client, INDEX_NAME
+from indexer import create_index
+from jobs import request_index, index_status
+from search import async_search_notes, async_search_notes_batch, MAX_EXPAND
+from watcher import start_watcher
+import metrics
+from common import (
+    async_redis_client, async_redis_binary_client,
+    WATCH_NOTES, FULL_SCAN_INTERVAL_HOURS, embedding_cache_stats, get_vector_store
+)
 
 def check_and_reindex():
     """
     Check if the index is empty or missing, and trigger indexing if needed.
     """
-    create_index()
-    
     try:
-        info = redis_client.ft(INDEX_NAME).info()
-        num_docs = int(info.get('num_docs', 0))
+        create_index()
+        num_docs = get_vector_store().stats()["num_docs"]
         if num_docs == 0:
             print("Index is empty. Triggering full re-indexing...")
-            index_notes()
+            request_index("empty_index")
     except Exception as e:
         print(f"Error checking index status: {e}. Indexing might be needed.")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # With the watcher running the full scan only reconciles changes it missed
+    watcher = start_watcher() if WATCH_NOTES else None
     scheduler = BackgroundScheduler()
-    scheduler.add_job(index_notes, 'interval', hours=1, id='index_job')
+    scheduler.add_job(request_index, 'interval', args=['schedule'], hours=FULL_SCAN_INTERVAL_HOURS if watcher else 1, id='index_job')
     scheduler.add_job(check_and_reindex, 'interval', minutes=5, id='check_empty_job')
     scheduler.start()
+    if watcher:
+        # Pick up notes changed while the server was down, the next full scan may be a day away
+        request_index("startup")
     
-    # Run initial index on startup in a separate thread/task to avoid blocking
-    # We use loop.run_in_executor for CPU-heavy indexing if needed, 
-    # but index_notes is synchronous and simple enough for now.
+    # Checking the index talks to Redis, keep it off the event loop. Indexing itself
+    # runs on the job thread of jobs.py.
     asyncio.create_task(asyncio.to_thread(check_and_reindex))
     
     yield
     scheduler.shutdown()
+    if watcher:
+        watcher.stop()
+    await async_redis_client.aclose()
+    await async_redis_binary_client.aclose()
 
 app = FastAPI(title="Obsidian RAG API", lifespan=lifespan)
 
 @app.get("/query")
-def query_rag(q: str = Query(..., description="The query string"), top_k: int = 5):
+async def query_rag(
+    q: str = Query(..., description="The query string"),
+    top_k: int = 5,
+    mode: Literal["vector", "hybrid", "lexical"] = Query("vector", description="Retrieval mode"),
+    path_prefix: str | None = Query(None, description="Only notes whose path starts with this prefix"),
+    folder: str | None = Query(None, description="Only notes in this top-level folder"),
+    tags: list[str] | None = Query(None, description="Only notes having any of these frontmatter tags"),
+    ef_runtime: int | None = Query(None, ge=1, description="HNSW EF_RUNTIME for this query, higher is slower but more accurate"),
+    rerank: Literal["none", "mmr"] = Query("none", description="mmr diversifies results with maximal marginal relevance"),
+    expand: int = Query(0, ge=0, le=MAX_EXPAND, description="Neighbor chunks merged into each result on each side")
+):
     """
     Search for relevant notes based on the query string.
     """
-    results = search_notes(q, top_k=top_k)
+    results = await async_search_notes(
+        q, top_k=top_k, mode=mode, path_prefix=path_prefix, folder=folder, tags=tags,
+        ef_runtime=ef_runtime, rerank=rerank, expand=expand
+    )
     return results
 
+class BatchQueryRequest(BaseModel):
+    queries: list[str]
+    top_k: int = 5
+    path_prefix: str | None = None
+    folder: str | None = None
+    tags: list[str] | None = None
+    ef_runtime: int | None = Field(None, ge=1)
+    rerank: Literal["none", "mmr"] = "none"
+    expand: int = Field(0, ge=0, le=MAX_EXPAND)
+
+@app.post("/query/batch")
+async def query_rag_batch(request: BatchQueryRequest):
+    """
+    Search for several query strings at once, returns one result list per query.
+    """
+    return await async_search_notes_batch(
+        request.queries, top_k=request.top_k,
+        path_prefix=request.path_prefix, folder=request.folder, tags=request.tags,
+        ef_runtime=request.ef_runtime, rerank=request.rerank, expand=request.expand
+    )
+
 @app.get("/ok")
 def ok():
     return {"status": "ok"}
 
-@app.post("/index")
+@app.get("/metrics")
+def prometheus_metrics():
+    """
+    Indexing and query metrics of this process in the Prometheus text format,
+    plus vector store and embedding cache figures.
+    """
+    gauges = {}
+    try:
+        stats = get_vector_store().stats()
+        gauges["prag_index_num_docs"] = ("Documents in the live index.", stats["num_docs"])
+        gauges["prag_index_vector_size_mb"] = ("Memory used by the vector index.", stats["vector_index_sz_mb"])
+        if "inverted_sz_mb" in stats:
+            gauges["prag_index_inverted_size_mb"] = ("Memory used by the full-text index.", stats["inverted_sz_mb"])
+        if "dead_rows" in stats:
+            gauges["prag_index_dead_rows"] = ("Replaced or deleted vectors awaiting compaction.", stats["dead_rows"])
+    except Exception as e:
+        print(f"Error reading index info for metrics: {e}")
+    try:
+        stats = embedding_cache_stats()
+        gauges["prag_embedding_cache_size"] = ("Vectors in the Redis embedding cache.", stats["size"])
+        gauges["prag_embedding_cache_hits"] = ("Embedding cache hits since the cache was created.", stats["hits"])
+        gauges["prag_embedding_cache_misses"] = ("Embedding cache misses since the cache was created.", stats["misses"])
+    except Exception as e:
+        print(f"Error reading embedding cache stats for metrics: {e}")
+    return Response(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.post("/index", status_code=202)
 def trigger_index():
     """
-    Manually trigger an indexing process.
+    Queue a full indexing run. Triggers made while a run is queued are
+    merged into it, follow it with /index/status.
+    """
+    job_id = request_index("api")
+    return {"message": "Indexing queued", "job_id": job_id}
+
+@app.get("/index/status")
+def indexing_status():
+    """
+    State, progress counters and ETA of the running or last indexing job,
+    plus the jobs of this replica waiting to run.
     """
-    index_notes()
-    return {"message": "Indexing started"}
+    return index_status()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,141 @@
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+from common import NOTES_PATH, WATCH_DEBOUNCE
+from jobs import request_index
+
+# inotify event bits, see inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len, followed by the name
+
+class NotesWatcher:
+    """
+    Watches NOTES_PATH recursively with inotify and queues a reindex of the
+    notes touched once no event arrived for WATCH_DEBOUNCE seconds. Hidden
+    directories are skipped like the scan in index_notes does. Directory
+    moves and event queue overflows fall back to a full scan.
+    """
+    def __init__(self, root=NOTES_PATH, debounce=WATCH_DEBOUNCE):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.root = os.path.abspath(root)
+        self.debounce = debounce
+        self.dirs = {}  # watch descriptor -> absolute directory
+        self.pending = set()
+        self.full_scan = False
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.add_tree(self.root)
+        print(f"Watching {len(self.dirs)} directories under {self.root}.")
+
+    def add_tree(self, abs_dir, queue_notes=False):
+        """
+        Watches abs_dir and its subdirectories. queue_notes also queues the
+        notes already there, for directories created or moved in after the
+        parent was watched.
+        """
+        for dirpath, dirnames, filenames in os.walk(abs_dir):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                print(f"Cannot watch {dirpath}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.dirs[wd] = dirpath
+            if queue_notes:
+                self.pending.update(os.path.join(dirpath, name) for name in filenames if name.endswith(".md"))
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.full_scan = True
+            return
+        if mask & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+        directory = self.dirs.get(wd)
+        if directory is None or name.startswith("."):
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path, queue_notes=True)
+            if mask & IN_MOVED_FROM:
+                # Notes under the old location are only known to the registry
+                self.full_scan = True
+        elif name.endswith(".md") and mask & (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE):
+            self.pending.add(path)
+
+    def flush(self):
+        full_scan, paths = self.full_scan, self.pending
+        self.full_scan, self.pending = False, set()
+        if full_scan:
+            request_index("watcher")
+        else:
+            request_index("watcher", [os.path.relpath(path, self.root) for path in paths])
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        last_event = 0
+        while not self.stop_event.is_set():
+            # Sleep until the next event, waking up at most every second to check for stop()
+            timeout = 1000
+            if self.pending or self.full_scan:
+                timeout = min(timeout, max(0, last_event + self.debounce - time.monotonic()) * 1000)
+            if poller.poll(timeout):
+                self.read_events()
+                last_event = time.monotonic()
+            elif (self.pending or self.full_scan) and time.monotonic() - last_event >= self.debounce:
+                self.flush()
+        os.close(self.fd)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="notes-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+def start_watcher():
+    """
+    Starts watching NOTES_PATH in a background thread. Returns None when
+    inotify is unavailable, callers then rely on periodic full scans.
+    """
+    try:
+        watcher = NotesWatcher()
+    except (OSError, AttributeError) as e:
+        print(f"Cannot watch {NOTES_PATH}, falling back to periodic indexing: {e!r}")
+        return None
+    watcher.start()
+    return watcher